@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Cost of accepting vs rejecting a document, with string and structured errors.
+
+    $ python benchmarks/errors.py
+
+@author: mikhail-matrosov
+"""
+
+import os
+import sys
+import timeit
+
+# Run from a checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from pycoercer import Validator  # noqa: E402
+
+SCHEMA = {
+    'type': 'dict',
+    'items': {
+        'id': {'coerce': 'int', 'min': 1},
+        'name': {'type': 'str', 'regex': '[A-Z][a-z]+'},
+        'tags': {
+            'type': 'list',
+            'values': {
+                'type': 'dict',
+                'items': {
+                    'key': {'type': 'str'},
+                    'value': {'any_of': [{'type': 'int'}, {'type': 'str'}]}
+                }
+            }
+        }
+    }
+}
+
+DOCS = {
+    'accept': {'id': '5', 'name': 'John',
+               'tags': [{'key': 'a', 'value': 1}, {'key': 'b', 'value': 'x'}]},
+    'reject type': {'id': '5', 'name': 'John',
+                    'tags': [{'key': 'a', 'value': 1}, {'key': 2}]},
+    'reject any_of': {'id': '5', 'name': 'John',
+                      'tags': [{'key': 'a', 'value': 1}, {'value': None}]},
+    'reject coerce': {'id': 'x', 'name': 'John', 'tags': []},
+}
+
+
+def bench(number=100000):
+    for structured in [False, True]:
+        f = Validator({'doc': SCHEMA}, structured_errors=structured)['doc']
+        print(f'structured_errors={structured}')
+        for case, doc in DOCS.items():
+            t = min(timeit.repeat(lambda: f(doc), number=number, repeat=5))
+            print(f'  {case:15}{t / number * 1e6:6.2f} us')
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Compile time, latency, throughput and memory on representative workloads.
+
+    $ python benchmarks/suite.py -o results.json
+    $ python benchmarks/suite.py --compare old.json -o new.json
+
+Documents are generated with a fixed seed, so runs differ by the code and
+the machine only. Every workload reports:
+    compile_ms - Validator(schemas) with code generation, no cache
+    latency_us - one call of validator[name], averaged over the documents
+    check_us - one call of validator.is_valid, averaged likewise
+    throughput - documents per second of validate_many
+    peak_kb - tracemalloc peak of validate_many over the documents
+The results file also holds the import time of pycoercer in a fresh
+interpreter and the versions of python and pycoercer.
+
+@author: mikhail-matrosov
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+# Run from a checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pycoercer  # noqa: E402
+from pycoercer import Validator  # noqa: E402
+
+# Metrics where more is better, for --compare
+HIGHER_IS_BETTER = {'throughput'}
+
+
+def flat(rng):
+    '''Records of 20 scalar fields'''
+    types = ['int', 'str', 'float', 'bool']
+    values = [lambda: rng.randrange(1000), lambda: rng.choice('abcdef') * 3,
+              rng.random, lambda: rng.random() < 0.5]
+    schema = {'type': 'dict', 'items': {
+        f'f{i}': {'type': types[i % 4], 'required': i < 10}
+        for i in range(20)}}
+    docs = [{f'f{i}': values[i % 4]() for i in range(20)}
+            for _ in range(1000)]
+    return {'flat': schema}, docs
+
+
+def nested(rng):
+    '''Dicts nested 8 levels deep'''
+    schema = {'type': 'dict', 'items': {'id': {'type': 'int', 'min': 0}}}
+    for _ in range(8):
+        schema = {'type': 'dict', 'items': {'id': {'type': 'int', 'min': 0},
+                                            'child': schema}}
+
+    def doc(depth):
+        d = {'id': rng.randrange(100)}
+        if depth:
+            d['child'] = doc(depth - 1)
+        return d
+
+    return {'nested': schema}, [doc(8) for _ in range(1000)]
+
+
+def large_lists(rng):
+    '''Lists of 1000 small records'''
+    schema = {'type': 'list', 'values': {'type': 'dict', 'items': {
+        'x': {'type': 'int', 'min': 0}, 'y': {'type': 'str'}}}}
+    docs = [[{'x': rng.randrange(100), 'y': 'abc'} for _ in range(1000)]
+            for _ in range(20)]
+    return {'large_lists': schema}, docs
+
+
+def recursive(rng):
+    '''Trees of about 100 nodes of a named recursive schema'''
+    schema = {'type': 'dict', 'items': {
+        'name': {'type': 'str'},
+        'children': {'type': 'list', 'values': 'recursive'}}}
+
+    def tree(n):
+        children = []
+        n -= 1
+        while n > 0:
+            size = rng.randint(1, n)
+            children.append(tree(size))
+            n -= size
+        return {'name': 'node', 'children': children}
+
+    return {'recursive': schema}, [tree(100) for _ in range(100)]
+
+
+def union(rng):
+    '''one_of with 16 branches told apart by a tag'''
+    branches = [{'type': 'dict', 'items': {
+        'kind': {'type': 'str', 'enum': [f'k{i}'], 'required': True},
+        f'v{i}': {'type': 'int'}}} for i in range(16)]
+    docs = []
+    for _ in range(1000):
+        i = rng.randrange(16)
+        docs.append({'kind': f'k{i}', f'v{i}': i})
+    return {'union': {'one_of': branches}}, docs
+
+
+def coercion(rng):
+    '''Records of strings coerced to numbers and bools'''
+    schema = {'type': 'dict', 'items': {
+        'i': {'coerce': 'int', 'min': 0},
+        'f': {'coerce': 'float'},
+        'n': {'coerce': 'number'},
+        'b': {'coerce': 'bool'},
+        's': {'coerce': 'str', 'max_len': 10},
+        'l': {'type': 'list', 'values': {'coerce': 'int'}}}}
+    docs = [{'i': str(rng.randrange(1000)), 'f': str(rng.random()),
+             'n': rng.choice(['1', '2.5']), 'b': rng.choice(['yes', 'no']),
+             's': rng.randrange(1000), 'l': ['1', '2', '3']}
+            for _ in range(1000)]
+    return {'coercion': schema}, docs
+
+
+def failures(rng):
+    '''Records of which 90% are invalid in different places'''
+    schemas, docs = flat(rng)
+    schemas = {'failures': schemas['flat']}
+    breaks = [lambda d: d.pop('f0'), lambda d: d.update(f1='x'),
+              lambda d: d.update(f9=None), lambda d: d.update(f19=1)]
+    for i, doc in enumerate(docs):
+        if i % 10:
+            rng.choice(breaks)(doc)
+    return schemas, docs
+
+
+WORKLOADS = [flat, nested, large_lists, recursive, union, coercion, failures]
+
+
+def best(f, number, repeat):
+    '''Min time of a call in seconds'''
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def run_workload(workload, repeat):
+    rng = random.Random(0)
+    schemas, docs = workload(rng)
+    name = workload.__name__
+
+    compile_s = best(lambda: Validator(schemas), 1, repeat)
+    v = Validator(schemas)
+    f = v[name]
+
+    def calls():
+        for doc in docs:
+            f(doc)
+
+    latency = best(calls, 1, repeat) / len(docs)
+    v.is_valid(name, docs[0])  # Checkers are compiled on the first call
+
+    def checks():
+        for doc in docs:
+            v.is_valid(name, doc)
+
+    check_latency = best(checks, 1, repeat) / len(docs)
+    v.validate_many(name, docs[:1])  # So is the batch function
+    many = best(lambda: v.validate_many(name, docs), 1, repeat)
+
+    tracemalloc.start()
+    try:
+        v.validate_many(name, docs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'docs': len(docs),
+            'compile_ms': compile_s * 1e3,
+            'latency_us': latency * 1e6,
+            'check_us': check_latency * 1e6,
+            'throughput': len(docs) / many,
+            'peak_kb': peak / 1024}
+
+
+def import_time(repeat):
+    '''Seconds to import pycoercer in a fresh interpreter'''
+    code = ('import time; t = time.perf_counter(); import pycoercer; '
+            'print(time.perf_counter() - t)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(
+        pycoercer.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    return min(float(subprocess.check_output([sys.executable, '-c', code],
+                                             env=env))
+               for _ in range(repeat))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run(names=None, repeat=5):
+    return {
+        'meta': {
+            'pycoercer': pycoercer.__version__,
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'repeat': repeat,
+        },
+        'import_ms': import_time(repeat) * 1e3,
+        'workloads': {w.__name__: run_workload(w, repeat)
+                      for w in WORKLOADS if not names or w.__name__ in names},
+    }
+
+
+def compare(old, new, threshold=0.1):
+    '''Lines of a report, regressions over threshold are marked with !'''
+    lines = []
+
+    def row(label, metric, a, b):
+        change = b / a - 1 if a else 0
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        mark = '!' if worse > threshold else ' '
+        lines.append(f'{mark} {label:30}{a:12.2f}{b:12.2f}{change:+9.1%}')
+
+    row('import_ms', 'import_ms', old['import_ms'], new['import_ms'])
+    for name, metrics in new['workloads'].items():
+        for metric, b in metrics.items():
+            a = old['workloads'].get(name, {}).get(metric)
+            if a is not None and metric != 'docs':
+                row(f'{name}.{metric}', metric, a, b)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-o', '--output', help='results file to write')
+    parser.add_argument('--compare', help='results file to compare with')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', metavar='WORKLOAD',
+                        choices=[w.__name__ for w in WORKLOADS])
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    print(f'import {results["import_ms"]:.1f} ms')
+    for name, m in results['workloads'].items():
+        print(f'{name:12} compile {m["compile_ms"]:7.1f} ms  '
+              f'latency {m["latency_us"]:8.2f} us  '
+              f'check {m["check_us"]:8.2f} us  '
+              f'{m["throughput"]:10.0f} docs/s  peak {m["peak_kb"]:8.1f} KB')
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f'\n  {"":30}{old["meta"]["pycoercer"]:>12}'
+              f'{results["meta"]["pycoercer"]:>12}')
+        print('\n'.join(compare(old, results)))
+
+
+if __name__ == '__main__':
+    main()
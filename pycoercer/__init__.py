@@ -6,4 +6,7 @@ Created on Mon Nov 25 16:58:15 2019
 @author: mikhail-matrosov
 """
 
+__version__ = '0.1.2'
+
+from .errors import ValidationError
 from .pycoercer import Options, Validator, pycoercer_schema
\ No newline at end of file
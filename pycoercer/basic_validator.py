@@ -5,8 +5,19 @@ Created on Wed Nov 20 19:35:46 2019
 @author: mikhail-matrosov
 """
 
+import asyncio
+import contextvars
+import threading
 from functools import wraps
-from pycoercer.code_generator import hash_obj, indent, cg_rules
+from time import perf_counter_ns
+from types import FunctionType
+from pycoercer import shared
+from pycoercer.code_generator import (hash_obj, hash_str, indent, cg_rules,
+                                      cg_many, checker_name, ck_rules,
+                                      async_name, uses_async, cyclic_rules)
+from pycoercer.errors import Rejected, ValidationError
+from pycoercer.memo import Memo
+from pycoercer.profile import Stat, profiled
 
 
 def log(*a, **kw):
@@ -14,14 +25,23 @@ def log(*a, **kw):
     pass
 
 
-def loopbreaker(f):
-    locks = set()
+def loopbreaker(f, checker=False):
+    '''
+    Returns doc as valid when f is already validating it up the stack.
+    Ids of the documents in progress are kept per thread, so concurrent
+    calls with the same document don't see each other.
+    '''
+    local = threading.local()
 
     @wraps(f)
-    def wrapper(doc, args):
+    def wrapper(doc, args=None):
+        try:
+            locks = local.ids
+        except AttributeError:
+            locks = local.ids = set()
         k = id(doc)
         if k in locks:
-            return doc, None
+            return True if checker else (doc, None)
 
         locks.add(k)
         try:
@@ -29,12 +49,33 @@ def loopbreaker(f):
         finally:  # Do after return
             locks.remove(k)
 
-    wrapper.locks = locks
+    wrapper.locks = local
     return wrapper
 
 
-def indent_str(s):
-    return '\n  '.join(s.splitlines()) if '\n' in s else s
+def async_loopbreaker(f):
+    '''loopbreaker for coroutines, ids are kept per asyncio task'''
+    ids = contextvars.ContextVar('ids', default=frozenset())
+
+    @wraps(f)
+    async def wrapper(doc, args=None):
+        locks = ids.get()
+        k = id(doc)
+        if k in locks:
+            return doc, None
+
+        token = ids.set(locks | {k})
+        try:
+            return await f(doc, args)
+        finally:
+            ids.reset(token)
+
+    wrapper.locks = ids
+    return wrapper
+
+
+async def _skip():
+    pass
 
 
 def schema_not_found(name):
@@ -45,78 +86,206 @@ def schema_not_found(name):
     return f
 
 
-def _compile(statements, name, _locals, schema, break_loops=False):
+def registry_wrapper(f):
+    '''
+    Registry function of f: errors are returned rendered, results of valid
+    documents are returned as is
+    '''
+    @wraps(f)
+    def wrapper(doc, args=None):
+        result = f(doc, args)
+        if result[1] is None:
+            return result
+        return None, result[1].render('Input')
+
+    return wrapper
+
+
+def _compile(statements, name, _locals, schema, break_loops=False,
+             checker=False, coroutine=False, stat=None):
+    '''stat - name of the Stat counting calls of the function'''
     f_cache = _locals.setdefault('_f_cache', {})
+    statements = [*statements, 'return True' if checker else 'return o, None']
+    if stat:
+        statements = [f'{stat}_t = _ns()', *profiled(statements, stat)]
+    header = f'{"async " if coroutine else ""}def {name}(o, args=None):'
 
-    h = hash_obj(statements)
+    # Guarded and plain twins of the same code are different functions
+    h = hash_str('\n'.join(statements)) + ('guarded' if break_loops else '')
     if h in f_cache:
         f = _locals[name] = f_cache[h]
         log(f'# {name} = {f.__name__}\n')
         return f
 
-    src = '\n'.join((f'def {name}(o, args):',
-                     *indent(statements),
-                     '    return o, None'))
+    src = '\n'.join((header, *indent(statements)))
 
     log(src + '\n')
-    exec(src, _locals)
+    if _locals.get('_share_code'):
+        src, code = shared.code(src)
+        _locals[name] = FunctionType(code, _locals, name, (None,))
+    else:
+        exec(src, _locals)
 
     func = _locals[name]
-    if break_loops:
-        func = loopbreaker(func)
-
     func.src = src
     func.schema = schema
+    if break_loops:  # Copies src and schema
+        func = (async_loopbreaker(func) if coroutine else
+                loopbreaker(func, checker))
 
     f_cache[h] = _locals[name] = func
     return func
 
 
-def registry_wrapper(f):
-    @wraps(f)
-    def wrapper(obj, args=None):
-        doc, err = f(obj, args)
-        if err:
-            return doc, 'Input' + err
-        return doc, None
-
-    return wrapper
-
-
 class BasicValidator:
     def __init__(self):
         self._schemas = {}
         self._positive_examples = {}
         self._negative_examples = {}
+        self._f_cache = {}  # Statements hash -> compiled function
+        self._share_code = False  # Use code of the process, pycoercer.shared
+        self._refs = set()  # Named schemas used by the last generated function
+        self._fp_memo = {}  # Fingerprints of schemas during code generation
+        self._pure = {}  # Purity of schemas during code generation
+        self._inlined = {}  # Inlined bodies of rules during code generation
+        self._checking = False  # Generating check-only code
+        self._async_target = False  # Generating coroutines
+        self._uses_async = {}  # Rules using async coercers during generation
+        self._shape = None  # Keys of the input of a specialized function
+        self._names = {}  # Hash of rules -> schema name, labels stats
 
         # Used by generated code
         self.self = self  # Compiled code can only access self.__dict__
-        self._indent_str = indent_str  # Format multiline errors
-
-    def generate_function(self, rules, options, name):
+        self._E = ValidationError
+        self._Rejected = Rejected
+        self._gather = asyncio.gather
+        self._skip = _skip
+        self._memos = {}  # Coercer name -> Memo
+        self._ns = perf_counter_ns
+
+    def generate_function(self, rules, options, name, checker=False,
+                          coroutine=False):
+        '''
+        checker - generate check-only code returning a bool instead of
+        the (normalized, error) tuple
+        coroutine - generate async code awaiting coroutine coercers
+        name - None for anonymous rules, their raw function is returned
+        '''
         _locals = self.__dict__
         self._todo = []
+        self._checking = checker
+        self._async_target = coroutine
+        self._refs.clear()
+        self._fp_memo.clear()
+        self._pure.clear()
+        self._inlined.clear()
+        self._uses_async.clear()
         fname, rules = self.resolve_rules(rules, options)
+        if name is not None:
+            self._names[fname] = name
+        stat = (options.profile and not checker and
+                self.profile_stat(fname, rules=rules))
+        if checker:
+            fname = checker_name(fname)
+        elif coroutine:
+            fname = async_name(fname)
+        # Only functions that can call themselves may loop on cyclic docs
+        cyclic = cyclic_rules(self, rules) if options.break_loops else ()
 
         log(f'# {name}\n# {rules}')
-        statements = list(cg_rules(self, rules, options))
-        func = _compile(statements, fname, _locals, rules, break_loops=True)
-
-        _locals[hash_obj(name)] = func  # Link previously loaded refs to f
+        statements = list((ck_rules if checker else cg_rules)(
+            self, rules, options))
+        func = _compile(statements, fname, _locals, rules,
+                        break_loops=id(rules) in cyclic, checker=checker,
+                        coroutine=coroutine, stat=stat)
+
+        entry = func
+        if name is not None:
+            # Link previously loaded refs to f
+            h = hash_obj(name)
+            _locals[checker_name(h) if checker else
+                    async_name(h) if coroutine else h] = func
+
+        # Calls the guarded function, so cyclic documents are caught at once
+        if not (name is None or checker or coroutine or
+                options.structured_errors):
+            entry = registry_wrapper(func)
 
         compiled_set = set()
 
-        for task, opts in self._todo:
-            fname = hash_obj(task, opts.__dict__)
+        for task, opts, ck, co in self._todo:
+            fname = hash_obj(task, opts.__dict__, memo=self._fp_memo)
+            stat = (opts.profile and not ck and
+                    self.profile_stat(fname, rules=task))
+            co = co and uses_async(self, task)  # Sync code otherwise
+            if ck:
+                fname = checker_name(fname)
+            elif co:
+                fname = async_name(fname)
             if fname not in compiled_set:  # Avoid recursion
                 compiled_set.add(fname)
                 log(f'# {task}')
-                statements = list(cg_rules(self, task, opts))
-                _compile(statements, fname, _locals, task)
+                self._checking = ck
+                self._async_target = co
+                statements = list((ck_rules if ck else cg_rules)(
+                    self, task, opts))
+                _compile(statements, fname, _locals, task,
+                         break_loops=id(task) in cyclic, checker=ck,
+                         coroutine=co, stat=stat)
 
         del self._todo
+        self._checking = False
+        self._async_target = False
+        self._fp_memo.clear()
+        self._pure.clear()
+        self._inlined.clear()
+        self._uses_async.clear()
 
-        return registry_wrapper(func)
+        return entry
+
+    def generate_specialized(self, rules, options, keys):
+        '''
+        Function of dict rules for inputs with exactly `keys`, see
+        pycoercer.shapes. It calls the functions compiled with the rules.
+        '''
+        _locals = self.__dict__
+        examples = self._positive_examples, self._negative_examples
+        self._positive_examples, self._negative_examples = {}, {}  # Tested
+        self._todo = []  # Compiled already
+        try:
+            fname, rules = self.resolve_rules(rules, options)
+            fname = hash_obj(fname, keys)
+            self._shape = keys
+            log(f'# {rules}\n# keys: {keys}')
+            statements = list(cg_rules(self, rules, options))
+            func = _compile(statements, fname, _locals, rules)
+            del _locals[fname]  # Not a part of the compiled schemas
+        finally:
+            del self._todo
+            self._shape = None
+            self._positive_examples, self._negative_examples = examples
+            self._fp_memo.clear()
+            self._pure.clear()
+            self._inlined.clear()
+        return func
+
+    def generate_batch(self, name):
+        '''
+        f(docs, args) -> (outputs, [(index, error)...]) for a compiled named
+        schema, outputs are None for invalid docs
+        '''
+        _locals = self.__dict__
+        func = _locals[hash_obj(name)]
+        fname = '_many' + func.__name__[1:]
+        arguments, body = cg_many(func.src)
+        src = '\n'.join((f'def {fname}({", ".join(arguments)}):',
+                         *indent(body)))
+        log(src + '\n')
+        exec(src, _locals)
+
+        batch = _locals.pop(fname)  # Not a part of the compiled schemas
+        batch.src = src
+        return batch
 
     def _test_examples(self):
         _locals = self.__dict__
@@ -134,6 +303,58 @@ class BasicValidator:
                     raise ValueError('Failed validating negative example '
                                      f'{example} agains schema {rules}')
 
+    def checker_stub(self, name):
+        '''Compiles the checker of a named schema on first call'''
+        def f(o, args=None):
+            if name not in self._schemas:
+                raise NameError(f"Schema {name} was not defined")
+            return self.checker[name](o, args)
+        f.__name__ = name
+        return f
+
+    def memo(self, name, maxsize):
+        '''Memo of coerce_<name>, grown to at least maxsize entries'''
+        memo = self._memos.get(name)
+        if memo is None:
+            memo = self._memos[name] = Memo(maxsize)
+        memo.maxsize = max(memo.maxsize, maxsize)
+        return memo
+
+    def profile_stat(self, h, rule=None, rules=None):
+        '''
+        Name of the Stat of a rule (None - the function) of rules hashed
+        to h, created on first use
+        '''
+        name = '_p' + hash_obj(h, rule)[1:]
+        if name not in self.__dict__:
+            label = self._names.get(h) or repr(rules)
+            self.__dict__[name] = Stat(label, rule)
+        return name
+
+    def coroutine_stub(self, name):
+        '''Compiles the coroutine of a named schema on first call'''
+        async def f(o, args=None):
+            if name not in self._schemas:
+                raise NameError(f"Schema {name} was not defined")
+            return await self.coroutine[name](o, args)
+        f.__name__ = name
+        return f
+
+    def schema_options(self, name):
+        '''Options a named schema is compiled with'''
+        return self.options
+
+    def flat_rules(self, rules):
+        '''Named schema and 'rules' inheritance -> plain dict of rules'''
+        if isinstance(rules, str):
+            rules = self._schemas.get(rules, NotImplemented)
+        if not isinstance(rules, dict):
+            return rules or {}
+        base = rules.get('rules')
+        if base:
+            rules = {**(self._schemas[base] or {}), **rules}
+        return rules
+
     def resolve_rules(self, rules, options=None):
         '''
         Idempotent
@@ -144,12 +365,17 @@ class BasicValidator:
         if not options:
             options = self.options
 
-        h = hash_obj(rules) if isinstance(rules, str) else hash_obj(rules, options.__dict__)
+        memo = self._fp_memo
+        h = (hash_obj(rules) if isinstance(rules, str) else
+             hash_obj(rules, options.__dict__, memo=memo))
 
         if rules is NotImplemented:
             return h, NotImplemented
 
         if isinstance(rules, str):
+            self._refs.add(rules)
+            if self._async_target and async_name(h) not in self.__dict__:
+                self.__dict__[async_name(h)] = self.coroutine_stub(rules)
             try:
                 return h, (self._schemas[rules] or {})
             except KeyError:
@@ -157,6 +383,7 @@ class BasicValidator:
                 self.__dict__[h] = schema_not_found(rules)
                 return h, NotImplemented
         elif rules:  # Avoid empty rulesets
-            self._todo.append((rules, options))
+            self._todo.append((rules, options, self._checking,
+                               self._async_target))
             return h, rules
         return h, {}
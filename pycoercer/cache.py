@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of compiled validators.
+
+Every Validator.update() call is stored as a single file holding marshalled
+code objects of the generated functions together with the helper objects
+they use (compiled regexes, enum sets, map dicts). Loading a cached update
+rebuilds the registry without running code generation or exec.
+
+@author: mikhail-matrosov
+"""
+
+import marshal
+import os
+import pickle
+import sys
+import tempfile
+from types import FunctionType
+
+import pycoercer
+from pycoercer import shared
+from pycoercer.basic_validator import (loopbreaker, registry_wrapper,
+                                       schema_not_found)
+from pycoercer.code_generator import fingerprint, hash_obj
+
+_stub_code = schema_not_found('').__code__
+
+
+def cache_key(validator, schemas, options):
+    '''Fingerprint of everything the generated code of an update depends on'''
+    coercers = sorted(k for k in validator.__dict__ if k.startswith('coerce_'))
+    memos = sorted(validator._memos)
+    return fingerprint((pycoercer.__version__, sys.implementation.cache_tag,
+                        schemas, options.__dict__, validator._schemas,
+                        coercers, memos)).hex()
+
+
+def snapshot(validator, before, schemas, names=None):
+    '''
+    Collect entries of validator.__dict__ created or replaced since `before`.
+    names - registry entries to restore, defaults to all of schemas.
+    '''
+    _locals = validator.__dict__
+    functions = {}  # id(func) -> [keys, name, code, defaults, src, schema,
+    #                               guarded]
+    stubs = {}
+    helpers = {}
+
+    for k, v in _locals.items():
+        if (before.get(k, before) is v or k == '__builtins__' or
+                k.startswith(('_is', '_async'))):  # Compiled on demand
+            continue
+        if hasattr(v, 'src'):
+            raw = getattr(v, '__wrapped__', v)
+            entry = functions.get(id(v))
+            if entry:
+                entry[0].append(k)
+            else:
+                functions[id(v)] = [[k], raw.__name__, raw.__code__,
+                                    raw.__defaults__, v.src, v.schema,
+                                    hasattr(v, 'locks')]
+        elif getattr(v, '__code__', None) is _stub_code:
+            stubs[k] = v.__name__
+        else:
+            helpers[k] = v
+
+    return {'functions': list(functions.values()),
+            'stubs': stubs,
+            'helpers': helpers,
+            'schemas': schemas,
+            'registry': list(schemas if names is None else names),
+            'deps': {name: sorted(validator._deps[name])
+                     for name in validator._deps},
+            'options': {name: options.__dict__
+                        for name, options in validator._options.items()},
+            'memos': {name: memo.maxsize
+                      for name, memo in validator._memos.items()}}
+
+
+def restore(validator, entry):
+    _locals = validator.__dict__
+
+    share = validator._share_code
+    for keys, name, code, defaults, src, schema, guarded in entry['functions']:
+        if share:
+            src, code = shared.code(src, code)
+        func = FunctionType(code, _locals, name, defaults)
+        func.src = src
+        func.schema = schema
+        if guarded:
+            func = loopbreaker(func)
+        for k in keys:
+            _locals[k] = func
+
+    for k, name in entry['stubs'].items():
+        _locals[k] = schema_not_found(name)
+
+    _locals.update(entry['helpers'] if not share else
+                   {k: shared.helper(k, v)
+                    for k, v in entry['helpers'].items()})
+    for name, maxsize in entry['memos'].items():
+        validator.memo(name, maxsize)
+    validator._schemas.update(entry['schemas'])
+    validator._deps.update((name, frozenset(refs))
+                           for name, refs in entry['deps'].items())
+    Options = type(validator.options)
+    validator._options.update((name, Options(**options))
+                              for name, options in entry['options'].items())
+    validator._drop_derived(entry['registry'])
+    validator.registry.update({
+        name: (_locals[hash_obj(name)]
+               if validator._options[name].structured_errors else
+               registry_wrapper(_locals[hash_obj(name)]))
+        for name in entry['registry']
+    })
+
+
+def load(cache_dir, key):
+    '''Returns a cached entry or None. Broken files are treated as misses.'''
+    try:
+        with open(os.path.join(cache_dir, key), 'rb') as f:
+            entry = pickle.load(f)
+        for func in entry['functions']:
+            func[2] = marshal.loads(func[2])
+        return entry
+    except Exception:
+        return None
+
+
+def dump(cache_dir, key, entry):
+    '''Atomically writes an entry, silently gives up if it can't be pickled'''
+    functions = [[*func[:2], marshal.dumps(func[2]), *func[3:]]
+                 for func in entry['functions']]
+    try:
+        data = pickle.dumps(dict(entry, functions=functions),
+                            pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(cache_dir, key))
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -5,12 +5,134 @@ Created on Wed Nov 20 18:55:05 2019
 @author: mikhail-matrosov
 """
 
+import inspect
+import marshal
 import re
+from hashlib import blake2b
 from pickle import dumps as pdumps
 
+from pycoercer import shared
+from pycoercer.profile import profiled
+from pycoercer.shapes import Shapes
 
-def hash_obj(*args):
-    return '_{:x}'.format(abs(hash(pdumps(args))))
+
+_scalars = {str, int, float, bool, type(None)}
+_containers = {dict, list, tuple, set, frozenset}
+
+
+def _token(obj, path):
+    '''Canonical representation of recursive objects and sets'''
+    t = type(obj)
+    if t in _scalars:
+        return repr(obj)
+
+    k = id(obj)
+    if k in path:  # Reference to a container being walked
+        return f'@{len(path) - path[k]}'
+
+    path[k] = len(path)
+    if t is dict:
+        tokens = [f'{_token(key, path)}:{_token(v, path)}'
+                  for key, v in obj.items()]
+    elif t in (list, tuple, set, frozenset):
+        tokens = [_token(v, path) for v in obj]
+        if t in (set, frozenset):
+            tokens.sort()
+    else:  # Regexes etc.
+        tokens = [pdumps(obj, 4).hex()]
+        t = object
+    del path[k]
+
+    data = ','.join(tokens).encode('utf-8', 'surrogatepass')
+    return t.__name__ + blake2b(data, digest_size=16).hexdigest()
+
+
+def _payload(obj):
+    '''Canonical bytes of scalars, digests and containers of them'''
+    try:
+        return marshal.dumps(obj, 2)  # Later versions share references
+    except ValueError:  # Regexes etc.
+        return pdumps(obj, 4)
+
+
+class _Cyclic(Exception):
+    '''A container holds itself'''
+
+
+def _digest(obj, memo, path):
+    '''
+    Merkle digest of an object: containers hash their items with nested
+    containers replaced by digests, cached in memo by id, so a container
+    shared by several others is digested once
+    '''
+    k = id(obj)
+    hit = memo.get(k)
+    if hit:
+        return hit[1]
+    if k in path:
+        raise _Cyclic
+
+    t = type(obj)
+    if t is dict:
+        items = obj
+        if not (_scalars.issuperset(map(type, obj.values())) and
+                _scalars.issuperset(map(type, obj))):
+            path.add(k)
+            items = [x if type(x) in _scalars else _digest(x, memo, path)
+                     for kv in obj.items() for x in kv]
+            path.discard(k)
+    elif t in _containers:
+        items = obj
+        if not _scalars.issuperset(map(type, obj)):
+            path.add(k)
+            items = [x if type(x) in _scalars else _digest(x, memo, path)
+                     for x in obj]
+            path.discard(k)
+        if t is set or t is frozenset:  # Order of set elements is not stable
+            try:
+                items = sorted(items)
+            except TypeError:  # Mixed types
+                items = sorted(items, key=repr)
+    else:
+        items = obj
+
+    h = blake2b(t.__name__.encode() + _payload(items),
+                digest_size=16).digest()
+    memo[k] = obj, h  # Keep obj alive so that its id is not reused
+    return h
+
+
+def fingerprint(obj, memo=None):
+    '''
+    Structural hash of JSON-like objects, including self-referential ones.
+    Does not depend on the process, PYTHONHASHSEED, set ordering or shared
+    references.
+    memo - dict to cache fingerprints of containers by id, valid while they
+    are not mutated.
+    '''
+    t = type(obj)
+    if t is str:
+        data = b's' + obj.encode('utf-8', 'surrogatepass')
+    elif t in _scalars:
+        data = _payload(obj)
+    else:
+        try:
+            return _digest(obj, {} if memo is None else memo, set())
+        except (_Cyclic, RecursionError):
+            data = b'w' + _token(obj, {}).encode('utf-8', 'surrogatepass')
+    return blake2b(data, digest_size=16).digest()
+
+
+def hash_str(s):
+    return '_' + blake2b(s.encode('utf-8', 'surrogatepass'),
+                         digest_size=8).hexdigest()
+
+
+def hash_obj(*args, memo=None):
+    if len(args) == 1:
+        return '_' + fingerprint(args[0], memo)[:8].hex()
+    data = b''.join([fingerprint(a, memo) for a in args])
+    return '_' + blake2b(data, digest_size=8).hexdigest()
 
 
 def escape(s):
@@ -27,82 +149,84 @@ def indent(seq, ind=1):
 
 def store_in_locals(obj, _locals, attr_name=None):
     name = hash_obj(obj)
-    _locals[name] = getattr(obj, attr_name) if attr_name else obj
+    value = getattr(obj, attr_name) if attr_name else obj
+    _locals[name] = (shared.helper(name, value)
+                     if _locals.get('_share_code') else value)
     return name
 
 
 def cg_type(val):
     if val is None:
         return [f'if o is not None:',
-                f'    return None, " type must be NoneType"']
+                f'    return None, _E("type", "NoneType")']
     return [('if not (isinstance(o, float) or isinstance(o, int)):'
              if val == 'number' else
             f'if not isinstance(o, {val}):'),
-            f'    return None, " type must be {val}"']
+            f'    return None, _E("type", "{val}")']
 
 
 def cg_enum(val, _locals):
     name = store_in_locals(val.copy(), _locals)
     try:
-        sname = store_in_locals(set(val), _locals)
+        sname = store_in_locals(frozenset(val), _locals)
         return [
              'try:',
             f'    if o not in {sname}:',
-            f'        return None, f" must be one of {{{name}}}"',
+            f'        return None, _E("enum", {name})',
              'except TypeError:',  # If o is not Hashable
-            f'    return None, f" must be one of {{{name}}}"']
+            f'    return None, _E("enum", {name})']
     except TypeError:  # Not hashable
         return [f'if o not in {name}:',
-                f'    return None, f" must be one of {{{name}}}"']
+                f'    return None, _E("enum", {name})']
 
 
 def cg_min(val):
     return [f'if o < {as_code(val)}:',
-            f"    return None, ' must be at least {as_code(val)}'"]
+            f'    return None, _E("min", {as_code(val)})']
 
 
 def cg_max(val):
     return [f'if o > {as_code(val)}:',
-            f"    return None, ' must be at most {as_code(val)}'"]
+            f'    return None, _E("max", {as_code(val)})']
 
 
 def cg_min_len(val):
     return [f'if len(o) < {val}:',
-            f'    return None, " length must be at least {val}"']
+            f'    return None, _E("min_len", {val})']
 
 
 def cg_max_len(val):
     return [f'if len(o) > {val}:',
-            f'    return None, " length must be at most {val}"']
+            f'    return None, _E("max_len", {val})']
 
 
 def cg_regex(val, _locals):
     name = store_in_locals(re.compile(val), _locals, 'fullmatch')
     return [f'if not {name}(o):',
-            f'    return None, " must match regex: {{}}".format({name}.__self__.pattern)']
+            f'    return None, _E("regex", {as_code(val)})']
 
 
 def cg_coerce_int(_locals):
     return ['try: o = int(o)',
-            'except:',
+            'except Exception:',
             '    try: o = int(float(o))',
-            '    except:',
-            '        return None, " is not coercible to int"']
+            '    except Exception:',
+            '        return None, _E("coerce", "int")']
 
 
 def cg_coerce_float(_locals):
     return ['try: o = float(o)',
-            'except:',
-            '    return None, " is not coercible to float"']
+            'except Exception:',
+            '    return None, _E("coerce", "float")']
 
 
 def cg_coerce_number(_locals):
     return ['if not isinstance(o, float):',
             '    try: o = int(o)',
-            '    except:',
+            '    except Exception:',
             '        try: o = float(o)',
-            '        except:',
-            '            return None, " is not coercible to number"']
+            '        except Exception:',
+            '            return None, _E("coerce", "number")']
 
 
 def cg_coerce_str(_locals):
@@ -119,7 +243,7 @@ def cg_coerce_bool(_locals):
     return ['try:',
             '    o = bool_map[str(o).lower()]',
             'except KeyError:',
-            '    return None, " is not coercible to bool"']
+            '    return None, _E("coerce", "bool")']
 
 
 def cg_map(val, _locals):
@@ -135,37 +259,170 @@ def cg_any_of(names):
         yield 4*i*' ' + f'if err{i}:'
 
     N = len(names)
-    errs = ', '.join(f'_indent_str(err{i})' for i in range(N))
-    fmt = ''.join(f'\\n{i+1}: ^{{}}' for i in range(N))
-    yield 4*N*' ' + f'return None, " must satisfy any of {N} rules:{fmt}".format({errs})'
+    errs = ', '.join(f'err{i}' for i in range(N))
+    yield 4*N*' ' + f'return None, _E("any_of", [{errs}])'
     yield from (4*i*' ' + f'else: o = r{i}' for i in reversed(range(N)))
 
 
 def cg_one_of(names):
-    N = len(names)
-    errs = '"^"+_indent_str(e) if e else "ok" for x, e in rs'
-    fmt = ''.join(f'\\n{i+1}: {{}}' for i in range(N))
-    calls = ', '.join(f'{name}(o, args)' for name in names)
-    return [
-    f'rs = [{calls}]',
-     'valid = [x for x, e in rs if not e]',
-     'if len(valid) == 1:',
-     '    o = valid[0]',
-     'else:',
-    f'    fmt = ({errs})',
-    f'    return None, " must satisfy exactly one of {N} rules:{fmt}".format(*fmt)']
+    # Stops after a second success, the rest is reported as not checked
+    yield f'rs = [{names[0]}(o, args)]'
+    yield  'n = not rs[0][1]'
+    for name in names[1:]:
+        yield  'if n < 2:'
+        yield f'    rs.append({name}(o, args))'
+        yield  '    n += not rs[-1][1]'
+    yield  'if n == 1:'
+    yield  '    o = next(x for x, e in rs if not e)'
+    yield  'else:'
+    yield (f'    return None, _E("one_of", [e for x, e in rs] + '
+           f'[...] * ({len(names)} - len(rs)))')
+
+
+# Rules of a branch that is nothing but a type check
+_type_rules = {'type', 'title', 'description', 'rules'}
+
+# Rules of a discriminator item that only accept or reject its value
+_tag_rules = {'enum', 'type', 'required', 'title', 'description', 'rules'}
+
+
+def branch_types(self, branches, options=None):
+    '''
+    Types of branches if all of them only check a type, else None.
+    options - of the branches, if given they must return the input as is,
+    as a dict does not with purge_unknown
+    '''
+    types = []
+    for branch in branches:
+        rules = self.flat_rules(branch)
+        if (not isinstance(rules, dict) or 'type' not in rules or
+                not rules.keys() <= _type_rules or
+                options is not None and not is_pure(self, branch, options)):
+            return None
+        types.append(rules['type'])
+    return types
+
+
+def discriminate(self, branches, key=None):
+    '''
+    (key, {value: branch index}) if branches are dicts told apart by
+    distinct enum values of the item `key`, None otherwise.
+    key=None - find such an item.
+    '''
+    flat = [self.flat_rules(rules) for rules in branches]
+    if not all(isinstance(rules, dict) and rules.get('type') == 'dict' and
+               not rules.keys() & {'coerce', 'nullable', 'if_null'}
+               for rules in flat):
+        return None
+    items = [rules.get('items') or {} for rules in flat]
+    keys = [key] if key is not None else [
+        k for k in items[0] if all(k in it for it in items[1:])]
+
+    for k in keys:
+        mapping = {}
+        n_values = 0
+        for i, it in enumerate(items):
+            rules = self.flat_rules(it.get(k))
+            if (not isinstance(rules, dict) or not rules.get('enum') or
+                    not rules.keys() <= _tag_rules):
+                break
+            try:
+                values = set(rules['enum'])
+            except TypeError:  # Not hashable
+                break
+            mapping.update(dict.fromkeys(values, i))
+            n_values += len(values)
+        else:
+            if len(mapping) == n_values:  # Distinct, even as 1 and True
+                return k, mapping
+    return None
+
+
+def type_check(t):
+    '''Code checking `o` has type t, as cg_type does'''
+    if t is None:
+        return '(o is None)'  # Summed in one_of
+    if t == 'number':
+        return 'isinstance(o, (float, int))'
+    return f'isinstance(o, {t})'
+
+
+def type_error(t):
+    return f'_E("type", "{"NoneType" if t is None else t}")'
+
+
+def cg_union(self, kind, branches, names, discriminator=None, options=None):
+    '''
+    any_of or one_of of branches compiled to functions `names`, options -
+    of the branches, None if their results are not used.
+    Type-only branches make a single check, branches with a discriminator
+    item run only the branch it selects. Anything failing runs the union
+    as is to report every branch.
+    '''
+    types = branch_types(self, branches, options)
+    if types and discriminator is None:
+        if kind == 'any_of':
+            classes = ', '.join('type(None)' if t is None else
+                                'float, int' if t == 'number' else t
+                                for t in types)
+            errs = ', '.join(map(type_error, types))
+            yield f'if not isinstance(o, ({classes},)):'
+            yield f'    return None, _E("any_of", [{errs}])'
+        else:
+            yield f'if ({" + ".join(map(type_check, types))}) != 1:'
+            errs = ', '.join(f'None if {type_check(t)} else {type_error(t)}'
+                             for t in types)
+            yield f'    return None, _E("one_of", [{errs}])'
+        return
+
+    union = list(globals()['cg_' + kind](names))
+    dispatch = discriminate(self, branches, discriminator)
+    if dispatch is None:
+        if discriminator is not None:
+            raise ValueError(f'Discriminator {discriminator} does not tell '
+                             f'{kind} branches apart: {branches}')
+        yield from union
+        return
+
+    key, mapping = dispatch
+    name = store_in_locals(mapping, self.__dict__)
+    yield  'try:'
+    yield f'    branch = {name}[o[{as_code(key)}]]'
+    yield  'except Exception:'
+    yield  '    branch = None'
+    for i, fname in enumerate(names):
+        yield f'{"el" if i else ""}if branch == {i}:'
+        yield f'    r, err = {fname}(o, args)'
+    yield  'else:'
+    yield  '    err = True'
+    yield  'if err:'
+    yield from indent(union)
+    yield  'else:'
+    yield  '    o = r'
+
+
+def is_builtin_coercer(self, name):
+    '''Coercers compiled inline, unless overridden by a coerce_* method'''
+    return ('coerce_' + name not in self.__dict__ and
+            'cg_coerce_' + name in globals())
 
 
 def cg_coerce(self, name, input_code='o'):
     _locals = self.__dict__
-    if 'coerce_'+name in _locals or 'cg_coerce_'+name not in globals():
+    if not is_builtin_coercer(self, name):
+        call = f'self.coerce_{name}({input_code}, args)'
+        if self._async_target and is_async_coercer(self, name):
+            call = 'await ' + call
+        elif name in self._memos:
+            call = (f'_memos[{as_code(name)}](self.coerce_{name}, '
+                    f'{input_code}, args)')
         return [
          'try:',
-        f'    o = self.coerce_{name}({input_code}, args)',
-         'except:',
+        f'    o = {call}',
+         'except Exception:',
         f'    if not hasattr(self, "coerce_{name}"):',
         f'        raise AttributeError("Validator has no attribute coerce_{name}")',
-        f'    return None, " is not coercible to {name}"']
+        f'    return None, _E("coerce", "{name}")']
     else:
         return globals()['cg_coerce_'+name](_locals)
 
@@ -182,6 +439,125 @@ def cg_nullable(self, if_null, post_coerce):
         yield f'    return {if_null}, None'
 
 
+# Rules that may return something else than the input
+_impure_rules = {'coerce', 'post_coerce', 'map', 'default', 'rename',
+                 'synonyms', 'if_null'}
+
+
+def is_pure(self, rules, options, _visited=None):
+    '''
+    True if rules never change the data, so the generated code may only
+    check it and return the input itself
+    '''
+    if isinstance(rules, str):
+        if rules not in self._schemas:
+            return False  # Might come later
+        options = self.schema_options(rules)
+        rules = self._schemas[rules]
+    if not rules:
+        return True
+
+    memo = self._pure
+    key = (id(rules), options.purge_unknown)
+    if key in memo:
+        return memo[key]
+    visited = {} if _visited is None else _visited
+    if key in visited:
+        return True  # Recursion: pure unless something else says otherwise
+    visited[key] = rules
+
+    pure = True
+    if 'rules' in rules:
+        base = self._schemas.get(rules['rules'], NotImplemented)
+        pure = base is not NotImplemented
+        rules = {**(base or {}), **rules} if pure else {}
+    rget = rules.get
+    inner_options = self.options.replace(**rules)
+
+    pure = pure and not (
+        rules.keys() & _impure_rules or
+        rget('type') == 'dict' and rget('purge_unknown', options.purge_unknown))
+    children = [*(rget('items') or {}).values(),
+                *(rget('pattern_items') or {}).values(),
+                rget('keys'), rget('values')]
+    pure = pure and all(is_pure(self, r, self.options, visited)
+                        for r in children)
+    pure = pure and all(is_pure(self, r, inner_options, visited)
+                        for k in ['any_of', 'one_of'] for r in rget(k) or [])
+
+    if pure and _visited is None:
+        # No assumption about recursion failed
+        memo.update((k, True) for k in visited)
+    elif not pure:
+        memo[key] = False
+    return pure
+
+
+def cyclic_rules(self, rules):
+    '''
+    Ids of rule sets reachable from rules that can reach themselves through
+    nested rules or named schemas. Only their functions need loopbreaker.
+    '''
+    index = {}  # id -> DFS order
+    low = {}
+    stack = []
+    on_stack = set()
+    cyclic = set()
+
+    def children(rules):
+        if 'rules' in rules:
+            rules = {**(self._schemas.get(rules['rules']) or {}), **rules}
+        rget = rules.get
+        for r in [*(rget('items') or {}).values(),
+                  *(rget('pattern_items') or {}).values(),
+                  rget('keys'), rget('values'),
+                  *(rget('any_of') or []), *(rget('one_of') or [])]:
+            if isinstance(r, str):
+                r = self._schemas.get(r)
+            if isinstance(r, dict) and r:
+                yield r
+
+    def visit(rules):  # Tarjan's strongly connected components
+        k = id(rules)
+        index[k] = low[k] = len(index)
+        stack.append(k)
+        on_stack.add(k)
+        for child in children(rules):
+            c = id(child)
+            if c not in index:
+                visit(child)
+                low[k] = min(low[k], low[c])
+            elif c in on_stack:
+                low[k] = min(low[k], index[c])
+            if c == k:
+                cyclic.add(k)
+        if low[k] == index[k]:
+            i = stack.index(k)
+            component = stack[i:]
+            del stack[i:]
+            on_stack.difference_update(component)
+            if len(component) > 1:
+                cyclic.update(component)
+
+    if isinstance(rules, dict) and rules:
+        visit(rules)
+    return cyclic
+
+
+def renames_to_items(self, items):
+    '''True if an item is renamed to another item of the same dict'''
+    keys = set(items or ())
+    targets = set()
+    for rules in (items or {}).values():
+        if isinstance(rules, str):
+            rules = self._schemas.get(rules)
+        if isinstance(rules, dict):
+            keys.update(rules.get('synonyms') or ())
+            if 'rename' in rules:
+                targets.add(rules['rename'])
+    return not targets.isdisjoint(keys)
+
+
 def cg_rules(self, rules, options):
     _locals = self.__dict__
     rules = rules or {}
@@ -189,6 +565,8 @@ def cg_rules(self, rules, options):
     globs = globals()
     resolve = self.resolve_rules
     rhash, rules = resolve(rules, options)
+    source = rules  # Labels stats, before 'rules' are merged in
+    shape, self._shape = self._shape, None  # Only for the top level
 
     # Resolve rules from 'rules' rule
     v = rget('rules')
@@ -203,63 +581,96 @@ def cg_rules(self, rules, options):
     if rget('negative_examples'):
         self._negative_examples[rhash] = (rules, rget('negative_examples'))
 
+    def timed(rule, lines):
+        if not options.profile or self._checking:
+            return lines
+        return cg_timed(self.profile_stat(rhash, rule, source), lines)
+
     if rget('nullable') or rget("if_null"):
-        yield from cg_nullable(self, rget("if_null"), rget('post_coerce'))
+        yield from timed('nullable', cg_nullable(
+            self, rget("if_null"), rget('post_coerce')))
 
     if 'type' in rules:
-        yield from cg_type(rules['type'])
+        yield from timed('type', cg_type(rules['type']))
 
     v = rget('coerce')
     if v:
-        yield from cg_coerce(self, v)
+        yield from timed('coerce', cg_coerce(self, v))
 
     v = rget('regex')
     if v:
-        yield from cg_regex(v, _locals)
+        yield from timed('regex', cg_regex(v, _locals))
 
     purge_unknown = rget('purge_unknown', options.purge_unknown)
     has_schema = any(map(rget, 'items values keys pattern_items'.split()))
 
     rtype = rget('type', rget('coerce'))
+    pure = inplace = False
+    nested = []  # Copy and items of dicts and lists
     if rtype in {'dict', 'list'} or has_schema:
-        if rtype == 'dict' and purge_unknown:
-            yield 'o, orig = {}, o'
+        pure = is_pure(self, rules, options)
+        if pure:  # Check only, no copy
+            nested.append('orig = o')
+        elif rtype == 'dict' and purge_unknown:
+            nested.append('o, orig = {}, o')
+        elif options.inplace and not renames_to_items(self, rget('items')):
+            inplace = True
+            nested.append('orig = o')
         else:
-            yield 'o, orig = o.copy(), o'
+            nested.append('o, orig = o.copy(), o')
 
     inner_options = self.options.replace(**rules)
 
     if has_schema:
         if rtype == 'list':
-            yield from cg_list_items(self, **rules, options=inner_options)
+            nested.extend(cg_list_items(self, **rules, options=inner_options,
+                                        pure=pure))
         else:
-            yield from cg_dict_items(self, **rules, options=inner_options)
+            nested.extend(cg_dict_items(self, **rules, options=inner_options,
+                                        pure=pure, inplace=inplace,
+                                        shape=shape))
+    if (options.specialize and shape is None and rget('type') == 'dict' and
+            rget('items') and not rget('coerce') and
+            not (self._checking or self._async_target)):
+        nested[:0] = cg_shapes(self, source, options)
+    if nested:
+        yield from timed('items', nested)
 
     v = rget('map')
     if v:
-        yield from cg_map(v, _locals)
+        yield from timed('map', cg_map(v, _locals))
 
     v = rget('enum')
     if v:
-        yield from cg_enum(v, _locals)
+        yield from timed('enum', cg_enum(v, _locals))
 
     for r in ['min', 'max', 'min_len', 'max_len']:
         v = rget(r)
         if v is not None:
-            yield from globs['cg_' + r](v)
+            yield from timed(r, globs['cg_' + r](v))
 
     for k in ['any_of', 'one_of']:
         v = rget(k)
         if v:
-            names = [resolve(r, inner_options)[0] for r in v]
-            yield from globs['cg_' + k](names)
+            names = [call_name(self, *resolve(r, inner_options)) for r in v]
+            yield from timed(k, cg_union(self, k, v, names,
+                                         rget('discriminator'),
+                                         inner_options))
 
     v = rget('post_coerce')
     if v:
-        yield from cg_coerce(self, v)
+        yield from timed('post_coerce', cg_coerce(self, v))
 
 
-def cg_default(k, k_to, rules, require_all):
+def cg_timed(stat, lines):
+    '''Lines of a rule counting its calls, failures and time in `stat`'''
+    yield f'{stat}_t = _ns()'
+    yield from profiled(lines, stat)
+    yield f'{stat}.ok({stat}_t, None)'
+
+
+def cg_missing(k, k_to, rules, require_all):
+    '''Statements for a missing item: default or required error'''
     if 'default' in rules:
         v = rules['default']
         if isinstance(v, str) and re.fullmatch('{.+}', v):
@@ -267,58 +678,227 @@ def cg_default(k, k_to, rules, require_all):
         else:
             default = as_code(v)
 
-        yield  'else:'
-        yield f'    o[{k_to}] = {default}'
+        yield f'o[{k_to}] = {default}'
     elif rules.get('required', require_all):
-        yield  'else:'
-        yield f'    return None, ".{escape(k)} is required"'
+        yield f'return None, _E("required").at(".{{}}", {as_code(k)})'
 
 
-def cg_key_value(k, fname, rules, require_all):
-    k_from = as_code(k)
-    k_to = as_code(rules['rename']) if rules and 'rename' in rules else k_from
-    val_source = (f'o.pop({k_from}, orig[{k_from}])'
-                  if 'rename' in rules else f'orig[{k_from}]')
-    yield from [
-        f'if {k_from} in orig:',
-        f'    o[{k_to}], err = {fname}({val_source}, args)',
-         '    if err:',
-        f'        return None, ".{escape(k)}" + err']
-
-    yield from cg_default(k, k_to, rules, require_all)
+def cg_shapes(self, rules, options):
+    '''Calls a function specialized for the keys of `o` if there is one'''
+    name = '_s' + hash_obj(rules, options.__dict__)[1:]
+    self.__dict__[name] = Shapes(rules, options)  # Forget outdated code
+    yield f'for keys, f in {name}.funcs:'
+    yield  '    if o.keys() == keys:'
+    yield  '        r, err = f(o, args)'
+    yield  '        if err:'
+    yield  '            return None, err'
+    yield  '        return r, None'
+    yield f'{name}.observe(o, self)'
 
 
-def cg_dict_item(self, key, rules, require_all, store_known_keys):
+def cg_default(k, k_to, rules, require_all):
+    missing = list(cg_missing(k, k_to, rules, require_all))
+    if missing:
+        yield 'else:'
+        yield from indent(missing)
+
+
+def cg_if_in(key, body, missing, shape=None):
+    '''
+    `if key in orig: body else: missing`, resolved in advance when the
+    keys of orig are known (shape)
+    '''
+    if shape is not None:
+        yield from body if key in shape else missing
+        return
+    yield f'if {as_code(key)} in orig:'
+    yield from indent(body)
+    if missing:
+        yield 'else:'
+        yield from indent(missing)
+
+
+# Rules producing straight code on `o` without nested calls or early success
+_inline_rules = {
+    'title', 'description', 'examples', 'negative_examples', 'allow_unknown',
+    'purge_unknown', 'rename', 'synonyms', 'required', 'require_all',
+    'default', 'type', 'coerce', 'map', 'enum', 'regex', 'rules', 'min', 'max',
+    'min_len', 'max_len', 'post_coerce', 'memo'}
+
+
+# String literals of generated code or the names `o` and `return` in it
+_o_or_return = re.compile(
+    r'''('(?:[^'\\\n]|\\.)*'|"(?:[^"\\\n]|\\.)*")|(?<![\w.])(o|return)\b''')
+
+
+def rename_o(code, new):
+    '''
+    Renames the variable `o` of generated code, strings are left intact.
+    None if the code returns anything but an error from the start of a line.
+    '''
+    inlinable = True
+
+    def sub(m):
+        nonlocal inlinable
+        if m[2] == 'o':
+            return new
+        if m[2] == 'return':
+            head = code[code.rfind('\n', 0, m.start()) + 1:m.start()]
+            inlinable = (inlinable and not head.strip() and
+                         code.startswith(' None, ', m.end()))
+        return m[0]
+
+    code = _o_or_return.sub(sub, code)
+    return code if inlinable else None
+
+
+def cg_inline(self, fname, rules):
+    '''
+    Body of a small leaf rule set compiled to fname working on `v` instead
+    of `o`. None if the compiled function has to be called instead. Rules
+    resolved right before are not compiled if they are inlined.
+    '''
+    key = fname, self._checking, self._async_target
+    inlined = self._inlined
+    if key not in inlined:
+        inlined[key] = inline_body(self, rules)
+    body = inlined[key]
+    if body is None:
+        return None
+
+    flat = self.flat_rules(rules)
+    if not (flat.get('examples') or flat.get('negative_examples')):
+        todo = self._todo  # Examples are tested on the function
+        for i in range(len(todo) - 1, -1, -1):
+            if todo[i][0] is rules:
+                del todo[i]
+                break
+    return body
+
+
+def inline_body(self, rules):
+    limit = self.options.inline_limit
+    if not limit or not isinstance(rules, dict):
+        return None
+    if self._async_target and uses_async(self, rules):
+        return None  # Called to be gathered with the others
+
+    merged = rules
+    if 'rules' in rules:
+        base = self.resolve_rules(rules['rules'])[1]
+        if not isinstance(base, dict):
+            return None
+        merged = {**base, **rules}
+    if (not merged.keys() <= _inline_rules or
+            {merged.get('type'), merged.get('coerce')} & {'dict', 'list'}):
+        return None
+
+    n = len(self._todo)
+    statements = list(cg_rules(self, rules, self.options))
+    del self._todo[n:]  # The leaf itself, queued by the caller already
+    if len(statements) > limit:
+        return None
+
+    body = rename_o('\n'.join(statements), 'v')
+    if body is None:
+        return None  # Success return can't be inlined
+    return body.split('\n')
+
+
+def cg_call(self, fname, rules, target, source, err_at, result=None):
+    '''
+    Validates `source` into `target`, err_at - arguments of ValidationError.at
+    locating errors.
+    Small leaf rules are inlined, otherwise fname is called.
+    No target - check only.
+    result - name of an already awaited (value, err) of the call
+    '''
+    if result:
+        return [f'{target or "_"}, err = {result}',
+                 'if err:',
+                f'    return None, err.at({err_at})']
+    body = cg_inline(self, fname, rules)
+    if body is None:
+        call = call_name(self, fname, rules)
+        return [f'{target or "_"}, err = {call}({source}, args)',
+                 'if err:',
+                f'    return None, err.at({err_at})']
+
+    def add_prefix(m):
+        return f'{m[1]}return None, {m[2]}.at({err_at})'
+
+    return [f'v = {source}',
+            *(re.sub(r'^(\s*)return None, (.*)$', add_prefix, line)
+              for line in body),
+            *([f'{target} = v'] if target else [])]
+
+
+def cg_key_value(self, k, fname, rules, require_all, pure=False,
+                 result=None, shape=None):
+    k_from = as_code(k)
+    key_rules = rules if isinstance(rules, dict) else {}
+    k_to = as_code(key_rules['rename']) if 'rename' in key_rules else k_from
+    val_source = (f'o.pop({k_from}, orig[{k_from}])'
+                  if 'rename' in key_rules else f'orig[{k_from}]')
+    body = []
+    if result and 'rename' in key_rules:
+        body.append(f'o.pop({k_from}, None)')
+    body += cg_call(self, fname, rules, not pure and f'o[{k_to}]',
+                    val_source, f'".{{}}", {k_from}', result)
+    yield from cg_if_in(k, body, list(cg_missing(k, k_to, key_rules,
+                                                 require_all)), shape)
+
+
+def cg_dict_item(self, key, rules, require_all, store_known_keys,
+                 pure=False, result=None, shape=None):
+    '''shape - keys of orig if known in advance'''
     fname, rules = self.resolve_rules(rules)
     k_from = as_code(key)
-    k_to = as_code(rules['rename']) if rules and 'rename' in rules else k_from
 
-    if rules is NotImplemented:
-        yield from cg_key_value(key, fname, {}, require_all)
+    if rules is NotImplemented:  # Rebuilt once the schema is defined
+        yield from cg_key_value(self, key, fname, rules, require_all,
+                                shape=shape)
     elif rules:
+        k_to = as_code(rules['rename']) if 'rename' in rules else k_from
         synonyms = rules.get('synonyms')
-        if synonyms:
+        if synonyms and shape is not None:
+            store_known_keys.update(synonyms)
+            k = next((k for k in [key, *synonyms] if k in shape), None)
+            if k is None:
+                yield from cg_missing(key, k_to, rules, require_all)
+            else:
+                k = as_code(k)
+                yield from cg_call(self, fname, rules, f'o[{k_to}]',
+                                   f'o.pop({k}, orig[{k}])', f'".{{}}", {k}')
+        elif synonyms:
             store_known_keys.update(synonyms)
 #            val_source = ('o.pop(k, orig[k])'
 #                          if 'rename' in rules else 'orig[k]')
             val_source = 'o.pop(k, orig[k])'
-            yield from [
-                f'for k in {[key] + synonyms}:',
-                 '    if k in orig:',
-                f'        o[{k_to}], err = {fname}({val_source}, args)',
-                 '        if err:',
-                 '            return None, f".{k}{err}"',
-                 '        break']
+            yield f'for k in {(key, *synonyms)!r}:'  # A constant
+            yield  '    if k in orig:'
+            yield from indent(cg_call(self, fname, rules, f'o[{k_to}]',
+                                      val_source, '".{}", k'), 2)
+            yield  '        break'
             yield from cg_default(key, k_to, rules, require_all)
         else:
-            yield from cg_key_value(key, fname, rules, require_all)
+            yield from cg_key_value(self, key, fname, rules, require_all,
+                                    pure, result, shape)
+    elif pure:
+        missing = list(cg_missing(key, k_from, {}, require_all))
+        if shape is None and missing:
+            yield f'if {k_from} not in orig:'
+            yield from indent(missing)
+        elif shape is not None and key not in shape:
+            yield from missing
     else:
-        yield f'if {k_from} in orig:'
-        yield f'    o[{k_to}] = orig[{k_from}]'
-        yield from cg_default(key, k_to, {}, require_all)
+        yield from cg_if_in(key, [f'o[{k_from}] = orig[{k_from}]'],
+                            list(cg_missing(key, k_from, {}, require_all)),
+                            shape)
 
 
-def cg_rule_key_value(self, keys, values, err_key_fmt='.{}'):
+def cg_rule_key_value(self, keys, values, err_key_fmt='.{}', pure=False):
+    '''Body of a loop over `k, item` of a dict or a list'''
     if keys is None:
         k_to, ind = 'k', ''
     else:
@@ -326,25 +906,25 @@ def cg_rule_key_value(self, keys, values, err_key_fmt='.{}'):
         if k_rules == {}:
             k_to, ind = 'k', ''
         else:
-            yield f'tk, k_err = {k_fname}(k, args)'
+            yield f'tk, k_err = {call_name(self, k_fname, k_rules)}(k, args)'
             yield  'if not k_err:'
             k_to, ind = 'tk', '    '
 
+    copy = 'pass' if pure else f'o[{k_to}] = item'
     if values:
         v_fname, v_rules = self.resolve_rules(values)
         if v_rules == {}:
-            yield ind + f'o[{k_to}] = orig[k]'
+            yield ind + copy
         else:
-            yield from [
-            ind + f'o[{k_to}], err = {v_fname}(orig[k], args)',
-            ind +  'if err:',
-            ind + f'    return None, "{err_key_fmt}{{}}".format(k, err)',
-            ind +  'continue']
+            yield from (ind + s for s in cg_call(
+                self, v_fname, v_rules, not pure and f'o[{k_to}]', 'item',
+                f'"{err_key_fmt}", k'))
+            yield ind + 'continue'
     else:
-        yield ind + f'o[{k_to}] = orig[k]'
+        yield ind + copy
 
 
-def cg_pattern_item(self, pattern_items):
+def cg_pattern_item(self, pattern_items, pure=False):
     _locals = self.__dict__
     resolve = self.resolve_rules
 
@@ -353,57 +933,528 @@ def cg_pattern_item(self, pattern_items):
     for ptrn in sorted(pattern_items, key=lambda p: (-len(p), p)):
         fname, rules = resolve(pattern_items[ptrn])
 
-        # TODO: check if rules is NotImplemented
         name = store_in_locals(re.compile(ptrn), _locals, 'fullmatch')
-        tk = as_code(rules['rename']) if rules and 'rename' in rules else 'k'
-
-        yield from [
-            f'    if {name}(k):',
-            f'        o[{tk}], err = {fname}(orig[k], args)',
-             '        if err:',
-             '            return None, f".{k}{err}"',
-             '        continue']
+        tk = (as_code(rules['rename'])
+              if isinstance(rules, dict) and 'rename' in rules else 'k')
+
+        yield f'    if {name}(k):'
+        yield from indent(cg_call(self, fname, rules, not pure and f'o[{tk}]',
+                                  'item', '".{}", k'), 2)
+        yield  '        continue'
         # TODO: required and default
 
 
 def cg_dict_items(self, items=None, pattern_items=None, keys=None, values=None,
-                  options=None, **_):
+                  options=None, pure=False, inplace=False, shape=None, **_):
+    '''shape - keys of orig if known in advance, see pycoercer.shapes'''
     known_keys = set(items) if items else set()
     _locals = self.__dict__
 
-    if items:
-        for key, rules in items.items():
-            yield from cg_dict_item(self, key, rules, options.require_all, known_keys)
+    results = {}
+    if self._async_target:
+        results = yield from cg_gather_items(self, items)
+
+    # Fills known_keys with synonyms
+    statements = [s for key, rules in (items or {}).items()
+                  for s in cg_dict_item(self, key, rules, options.require_all,
+                                        known_keys, pure, results.get(key),
+                                        shape)]
 
     pattern_items = pattern_items or {}
-    if pattern_items or keys is not None or values is not None:
-        if known_keys:
-            kk_name = store_in_locals(known_keys, _locals)
-            yield f'for k in set(orig) - {kk_name}:'
+    loop = pattern_items or keys is not None or values is not None
+    extra = shape and shape - known_keys
+    if shape is not None and not (extra and loop):
+        # Unknown keys are known in advance, only checks of their values
+        # need the loop
+        yield from statements
+        if extra and not options.allow_unknown:
+            name = store_in_locals(frozenset(extra), _locals)
+            yield f'return None, _E("unknown_keys", set({name}))'
+        return
+
+    known = known_keys and store_in_locals(frozenset(known_keys), _locals)
+
+    unknown = None
+    if inplace and (loop or not options.allow_unknown):
+        # Items write to orig, collect unknown keys before them
+        yield ('unknown = ' + (f'set(orig) - {known}' if known else
+                               'list(orig)' if loop else 'set(orig)'))
+        unknown = 'unknown'
+
+    yield from statements
+
+    # No temporary sets on success: the loop skips known keys, the check
+    # compares key views
+    if loop:
+        if unknown:
+            yield  'for k in unknown:'
+            yield  '    item = orig[k]'
         else:
-            yield 'for k in orig:'
+            yield  'for k, item in orig.items():'
+            if known:
+                yield f'    if k in {known}:'
+                yield  '        continue'
 
         if pattern_items:
-            yield from indent(cg_pattern_item(self, pattern_items))
+            yield from indent(cg_pattern_item(self, pattern_items, pure))
 
         if keys is not None or values is not None:
-            yield from indent(cg_rule_key_value(self, keys, values))
+            yield from indent(cg_rule_key_value(self, keys, values,
+                                                pure=pure))
 
         if not options.allow_unknown:
-            yield '    return None, f" must not contain key {k}"'
+            yield '    return None, _E("unknown_key", k)'
 
     elif not options.allow_unknown:
-        kk_name = store_in_locals(known_keys, _locals)
-        yield from [
-        f'forbidden_keys = set(orig) - {kk_name}',
-         'if forbidden_keys:',
-         '    return None, f" must not contain keys {forbidden_keys}"']
+        if unknown:
+            check, forbidden = 'unknown', 'unknown'
+        elif known:
+            check = f'not orig.keys() <= {known}'
+            forbidden = f'set(orig) - {known}'
+        else:
+            check, forbidden = 'orig', 'set(orig)'
+        yield f'if {check}:'
+        yield f'    return None, _E("unknown_keys", {forbidden})'
+
 
+def cg_list_items(self, keys=None, values=None, pure=False, **_):
+    if self._async_target and keys is None and values is not None:
+        fname, rules = self.resolve_rules(values)
+        if uses_async(self, rules):
+            yield f'rs = await _gather(*[{async_name(fname)}(v, args) for v in orig])'
+            yield  'for k, (v, err) in enumerate(rs):'
+            yield  '    if err:'
+            yield  '        return None, err.at("[{}]", k)'
+            yield  '    o[k] = v'
+            return
 
-def cg_list_items(self, keys=None, values=None, **_):
-    yield 'for k in range(len(orig)):'
+    yield 'for k, item in enumerate(orig):'
 
     if values is not None:
         yield from indent(cg_rule_key_value(
-                self, keys, values, err_key_fmt='[{}]'))
+                self, keys, values, err_key_fmt='[{}]', pure=pure))
+
+
+# Builtins bound to locals of batch functions
+_hoisted = ('isinstance', 'int', 'float', 'str', 'bool', 'len', 'type', '_E')
+
+
+def cg_many(src):
+    '''
+    (arguments, body) of a function validating a list of documents, src -
+    source of the single document function. Its body is inlined into the
+    loop. Errors inside loops of its own raise Rejected to leave them,
+    bodies returning results from such loops are called instead.
+    '''
+    header, *body = src.splitlines()
+    fname = header[4:header.index('(')]
+
+    lines = []
+    loops = []  # Indents of the loops a line is in
+    for i, line in enumerate(body, 1):
+        ind = len(line) - len(line.lstrip())
+        while loops and loops[-1] >= ind:
+            loops.pop()
+        m = re.match(r'(\s*)return (.*)$', line)
+        if not m:
+            lines.append(line)
+            if re.match(r'\s*(for|while) ', line):
+                loops.append(ind)
+        elif m[2].endswith(', None'):  # Success
+            if loops:
+                lines = None
+                break
+            lines.append(f'{m[1]}append({m[2][:-len(", None")]})')
+            if i < len(body):
+                lines.append(f'{m[1]}continue')
+        elif loops:
+            lines.append(f'{m[1]}raise _Rejected({m[2][len("None, "):]})')
+        else:
+            lines.append(f'{m[1]}append(None)')
+            lines.append(f'{m[1]}fail((i, {m[2][len("None, "):]}))')
+            lines.append(f'{m[1]}continue')
+
+    code = '\n'.join(lines or [fname])
+    names = [n for n in _hoisted if re.search(rf'\b{n}\b', code)]
+    arguments = ['docs', 'args', *(f'{n}={n}' for n in names)]
+
+    body = ['out = []',
+            'errors = []',
+            'append = out.append',
+            'fail = errors.append',
+            'for i, o in enumerate(docs):']
+    if lines is None:  # Called
+        body += [f'    r, err = {fname}(o, args)',
+                  '    append(r)',
+                  '    if err:',
+                  '        fail((i, err))']
+    elif any('raise _Rejected(' in line for line in lines):
+        body += ['    try:',
+                 *indent(lines),
+                 '    except _Rejected as e:',
+                 '        append(None)',
+                 '        fail((i, e.err))']
+    else:
+        body += lines
+    body.append('return out, errors')
+    return arguments, body
+
+
+# Check-only code: same rules, functions return True or False
+
+
+def checker_name(fname):
+    return '_is' + fname[1:]
+
+
+def as_check(lines):
+    '''Normalizing statements -> check-only ones'''
+    for line in lines:
+        m = re.match(r'(\s*)return (.*)$', line)
+        if m:
+            yield m[1] + ('return True' if m[2].endswith(', None') else
+                          'return False')
+        else:
+            yield line
+
+
+def ck_resolve(self, rules):
+    '''resolve_rules for check-only functions'''
+    fname, resolved = self.resolve_rules(rules)
+    fname = checker_name(fname)
+    if isinstance(rules, str) and fname not in self.__dict__:
+        self.__dict__[fname] = self.checker_stub(rules)
+    return fname, resolved
+
+
+def ck_call(self, fname, rules, source):
+    body = cg_inline(self, fname, rules)
+    if body is None:
+        return [f'if not {fname}({source}, args):',
+                 '    return False']
+    return [f'v = {source}', *as_check(body)]
+
+
+def ck_rules(self, rules, options):
+    '''
+    Check-only twin of cg_rules: no output is built and no error formatted.
+    Containers with rules checking the normalized result call the
+    normalizing function.
+    '''
+    _locals = self.__dict__
+    rules = rules or {}
+    rget = rules.get
+    resolve = self.resolve_rules
+    fname, orig_rules = resolve(rules, options)
+
+    v = rget('rules')
+    if v:
+        old_rules, rules = rules, resolve(v)[1].copy()
+        rules.update(old_rules)
+        rget = rules.get
 
+    has_schema = any(map(rget, 'items values keys pattern_items'.split()))
+    rtype = rget('type', rget('coerce'))
+    post = {r for r in ['map', 'enum', 'min', 'max', 'min_len', 'max_len']
+            if rget(r) is not None}
+    if rtype == 'list':
+        post -= {'min_len', 'max_len'}  # Normalization keeps the length
+    alternatives = rget('any_of') or rget('one_of')
+
+    if (has_schema and (post or alternatives or rget('post_coerce') or
+                        rtype == 'list' and rget('keys') is not None) or
+            alternatives and rget('post_coerce') or
+            (rget('nullable') or rget('if_null')) and rget('post_coerce')):
+        self._todo.append((orig_rules, options, False, False))
+        yield f'return not {fname}(o, args)[1]'
+        return
+
+    if rget('nullable') or rget('if_null'):
+        yield from as_check(cg_nullable(self, rget('if_null'), None))
+
+    if 'type' in rules:
+        yield from as_check(cg_type(rules['type']))
+
+    v = rget('coerce')
+    if v:
+        yield from as_check(cg_coerce(self, v))
+
+    v = rget('regex')
+    if v:
+        yield from as_check(cg_regex(v, _locals))
+
+    inner_options = self.options.replace(**rules)
+
+    if has_schema:
+        if rtype == 'list':
+            yield from ck_list_items(self, **rules)
+        else:
+            yield from ck_dict_items(self, **rules, options=inner_options)
+
+    v = rget('map')
+    if v:
+        yield from cg_map(v, _locals)
+
+    v = rget('enum')
+    if v:
+        yield from as_check(cg_enum(v, _locals))
+
+    for r in ['min', 'max', 'min_len', 'max_len']:
+        v = rget(r)
+        if v is not None:
+            yield from as_check(globals()['cg_' + r](v))
+
+    for k in ['any_of', 'one_of']:
+        v = rget(k)
+        if v:
+            names = [ck_resolve(self, r)[0] for r in v]
+            yield from ck_union(self, k, v, names, rget('discriminator'))
+
+    v = rget('post_coerce')
+    if v:
+        yield from as_check(cg_coerce(self, v))
+
+
+def ck_union(self, kind, branches, names, discriminator=None):
+    '''Check-only cg_union: a failed selected branch fails the union'''
+    if branch_types(self, branches) and discriminator is None:
+        yield from as_check(cg_union(self, kind, branches, names))
+        return
+
+    calls = [f'{name}(o, args)' for name in names]
+    if kind == 'any_of':
+        union = [f'if not ({" or ".join(calls)}):',
+                  '    return False']
+    else:  # Stops after a second success
+        union = [f'n = {calls[0]}']
+        for call in calls[1:-1]:
+            union += [f'n += {call}', 'if n > 1:', '    return False']
+        union += [f'n += {calls[-1]}'] if len(calls) > 1 else []
+        union += ['if n != 1:', '    return False']
+
+    dispatch = discriminate(self, branches, discriminator)
+    if dispatch is None:
+        if discriminator is not None:
+            raise ValueError(f'Discriminator {discriminator} does not tell '
+                             f'{kind} branches apart: {branches}')
+        yield from union
+        return
+
+    key, mapping = dispatch
+    name = store_in_locals(mapping, self.__dict__)
+    yield  'try:'
+    yield f'    branch = {name}[o[{as_code(key)}]]'
+    yield  'except Exception:'
+    yield  '    branch = None'
+    for i, call in enumerate(calls):
+        yield f'{"el" if i else ""}if branch == {i}:'
+        yield f'    if not {call}:'
+        yield  '        return False'
+    yield  'else:'
+    yield from indent(union)
+
+
+def ck_dict_items(self, items=None, pattern_items=None, keys=None, values=None,
+                  options=None, **_):
+    known_keys = set(items) if items else set()
+    _locals = self.__dict__
+
+    for key, rules in (items or {}).items():
+        fname, rules = ck_resolve(self, rules)
+        k = as_code(key)
+        key_rules = rules if isinstance(rules, dict) else {}
+        required = ('default' not in key_rules and
+                    key_rules.get('required', options.require_all))
+        synonyms = key_rules.get('synonyms')
+
+        if synonyms:
+            known_keys.update(synonyms)
+            yield f'for k in {(key, *synonyms)!r}:'
+            yield  '    if k in o:'
+            yield from indent(ck_call(self, fname, rules, 'o[k]'), 2)
+            yield  '        break'
+            if required:
+                yield 'else:'
+                yield '    return False'
+        elif rules != {}:
+            yield f'if {k} in o:'
+            yield from indent(ck_call(self, fname, rules, f'o[{k}]'))
+            if required:
+                yield 'else:'
+                yield '    return False'
+        elif required:
+            yield f'if {k} not in o:'
+            yield  '    return False'
+
+    pattern_items = pattern_items or {}
+    kk_name = store_in_locals(frozenset(known_keys), _locals)
+    if pattern_items or keys is not None or values is not None:
+        yield 'for k, item in o.items():'
+        if known_keys:
+            yield f'    if k in {kk_name}:'
+            yield  '        continue'
+
+        if pattern_items:
+            yield '    if isinstance(k, str):'
+            for ptrn in sorted(pattern_items, key=lambda p: (-len(p), p)):
+                fname, rules = ck_resolve(self, pattern_items[ptrn])
+                name = store_in_locals(re.compile(ptrn), _locals, 'fullmatch')
+                yield f'        if {name}(k):'
+                yield from indent(ck_call(self, fname, rules, 'item'), 3)
+                yield  '            continue'
+
+        if keys is not None or values is not None:
+            yield from indent(ck_rule_key_value(self, keys, values))
+
+        if not options.allow_unknown:
+            yield '    return False'
+
+    elif not options.allow_unknown:
+        yield f'if not o.keys() <= {kk_name}:'
+        yield  '    return False'
+
+
+def ck_rule_key_value(self, keys, values):
+    ind = ''
+    if keys is not None:
+        k_fname, k_rules = ck_resolve(self, keys)
+        if k_rules != {}:
+            yield f'if {k_fname}(k, args):'
+            ind = '    '
+
+    if values:
+        fname, rules = ck_resolve(self, values)
+        if rules != {}:
+            yield from (ind + s for s in ck_call(self, fname, rules, 'item'))
+            yield ind + 'continue'
+            return
+    if ind:
+        yield ind + 'pass'
+
+
+def ck_list_items(self, values=None, **_):
+    if values:
+        fname, rules = ck_resolve(self, values)
+        if rules != {}:
+            body = cg_inline(self, fname, rules)
+            if body is None:
+                yield  'for v in o:'
+                yield f'    if not {fname}(v, args):'
+                yield  '        return False'
+            elif body:
+                yield 'for v in o:'
+                yield from indent(as_check(body))
+
+
+# Async code: coroutine coerce_* functions are awaited, rules using them
+# compile to coroutines, the rest is called synchronously
+
+
+def async_name(fname):
+    return '_async' + fname[1:]
+
+
+def is_async_coercer(self, name):
+    _locals = self.__dict__
+    return (('coerce_'+name in _locals or 'cg_coerce_'+name not in globals())
+            and inspect.iscoroutinefunction(getattr(self, 'coerce_'+name,
+                                                    None)))
+
+
+def uses_async(self, rules, _visited=None):
+    '''True if rules or rules nested in them use a coroutine coercer'''
+    if isinstance(rules, str):
+        rules = self._schemas.get(rules)
+    if not isinstance(rules, dict) or not rules:
+        return False
+
+    memo = self._uses_async
+    key = id(rules)
+    if key in memo:
+        return memo[key]
+    visited = set() if _visited is None else _visited
+    if key in visited:
+        return False  # Recursion: decided by the rest of the rules
+    visited.add(key)
+
+    if 'rules' in rules:
+        rules = {**(self._schemas.get(rules['rules']) or {}), **rules}
+    rget = rules.get
+    children = [*(rget('items') or {}).values(),
+                *(rget('pattern_items') or {}).values(),
+                rget('keys'), rget('values'),
+                *(rget('any_of') or []), *(rget('one_of') or [])]
+    result = (any(isinstance(rget(k), str) and is_async_coercer(self, rget(k))
+                  for k in ['coerce', 'post_coerce']) or
+              any(uses_async(self, r, visited) for r in children))
+
+    if result:
+        memo[key] = True
+    elif _visited is None:  # Nothing reachable is async
+        memo.update((k, False) for k in visited)
+    return result
+
+
+def declared_memos(self, rules, _visited=None):
+    '''
+    (coercer, maxsize) of 'memo' rules in rules or rules nested in them,
+    registered before any code is generated so that it does not depend on
+    the order of compilation
+    '''
+    if isinstance(rules, str):
+        rules = self._schemas.get(rules)
+    visited = set() if _visited is None else _visited
+    if not isinstance(rules, dict) or id(rules) in visited:
+        return
+    visited.add(id(rules))
+
+    if 'rules' in rules:
+        rules = {**(self._schemas.get(rules['rules']) or {}), **rules}
+    rget = rules.get
+    if rget('memo'):
+        for k in ['coerce', 'post_coerce']:
+            name = rget(k)
+            if not isinstance(name, str):
+                continue
+            if is_builtin_coercer(self, name):
+                raise ValueError(f"'memo' has no effect on the builtin "
+                                 f"coercer {name}: {rules}")
+            yield name, rget('memo')
+
+    for r in [*(rget('items') or {}).values(),
+              *(rget('pattern_items') or {}).values(),
+              rget('keys'), rget('values'),
+              *(rget('any_of') or []), *(rget('one_of') or [])]:
+        yield from declared_memos(self, r, visited)
+
+
+def call_name(self, fname, rules):
+    '''Expression calling a compiled function, awaited if it is async'''
+    if self._async_target and uses_async(self, rules):
+        return 'await ' + async_name(fname)
+    return fname
+
+
+def cg_gather_items(self, items):
+    '''
+    Awaits async items of a dict all at once, returns item -> name of
+    its (value, err)
+    '''
+    if renames_to_items(self, items):
+        return {}  # Items depend on each other
+    calls = {}
+    for key, rules in (items or {}).items():
+        fname, resolved = self.resolve_rules(rules)
+        if (isinstance(resolved, dict) and not resolved.get('synonyms') and
+                uses_async(self, resolved)):
+            k = as_code(key)
+            calls[key] = (f'{async_name(fname)}(orig[{k}], args) '
+                          f'if {k} in orig else _skip()')
+    if len(calls) < 2:
+        return {}
+
+    results = {key: f'r{i}' for i, key in enumerate(calls)}
+    yield f'{", ".join(results.values())} = await _gather('
+    yield from (f'    {call},' for call in calls.values())
+    yield ')'
+    return results
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Columnar validation of record batches.
+
+A batch is a dict of equal-length columns validated against a
+'type': 'dict' schema, row i being {key: column[i] for key in columns}.
+NumPy arrays with a native dtype are checked as a whole: dtype kind for
+type, vectorized coerce to int/float/number/bool, isin for enum and masks
+for min, max, min_len and max_len. Lists, object arrays, other rules and
+arrays the vectorized code would treat differently (floats out of the
+int64 range coerced to int, enums of other types than the values) go
+through the generated per-value code, so results are the same either way.
+NumPy is optional.
+
+@author: mikhail-matrosov
+"""
+
+import re
+
+from pycoercer.code_generator import bool_map, hash_obj
+from pycoercer.errors import ValidationError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Python types matching dtype kinds, as for values of array.tolist()
+_KINDS = {'int': 'iub', 'float': 'f', 'number': 'iubf', 'str': 'U',
+          'bool': 'b'}
+
+# Dtype kinds of coerced arrays
+_COERCED = {'int': 'i', 'float': 'f', 'bool': 'b'}
+
+_TRUE = [k for k, v in bool_map.items() if v]
+_FALSE = [k for k, v in bool_map.items() if not v]
+
+# Rules with vectorized implementations, the rest is about the key
+_VECTOR_RULES = {'type', 'coerce', 'enum', 'min', 'max', 'min_len', 'max_len',
+                 'title', 'description', 'examples', 'negative_examples',
+                 'rename', 'synonyms', 'required', 'default'}
+
+
+def _vectorizable(a, rules):
+    if np is None or not isinstance(a, np.ndarray) or a.ndim != 1:
+        return False
+    kind = a.dtype.kind
+    if kind not in 'iubfU' or not rules.keys() <= _VECTOR_RULES:
+        return False
+    if rules.get('type', 'str') not in _KINDS:
+        return False
+    coerce = rules.get('coerce')
+    if coerce in ('int', 'float', 'number'):
+        if kind not in 'iubf':
+            return False
+        if coerce != 'float' and not _fits_int64(a):
+            return False  # Python ints don't overflow
+    elif coerce not in (None, 'bool') and _KINDS.get(coerce) != kind:
+        return False  # Only no-op coercions, like str of strings
+    kind = _COERCED.get(coerce, kind)
+    if rules.get('enum'):  # isin casts the values to a common type
+        numeric = kind in 'iubf'
+        if not all(isinstance(e, (int, float)) if numeric else
+                   isinstance(e, str) for e in rules['enum']):
+            return False
+    if 'min_len' in rules or 'max_len' in rules:
+        return kind == 'U'
+    return True
+
+
+def _fits_int64(a):
+    '''astype(np.int64) keeps the values of a'''
+    if a.dtype.kind == 'f':
+        a = np.abs(a[np.isfinite(a)])
+        return not a.size or a.max() < 2.0 ** 63
+    if a.dtype.kind == 'u' and a.dtype.itemsize == 8:
+        return not a.size or a.max() < 2 ** 63
+    return True
+
+
+def _to_bool(a):
+    '''Coerces as bool_map[str(o).lower()], returns the array and failures'''
+    kind = a.dtype.kind
+    if kind == 'b':
+        return a, np.zeros(len(a), bool)
+    if kind == 'U':
+        a = np.char.lower(a)
+        true, false = np.isin(a, _TRUE), np.isin(a, _FALSE)
+    else:
+        true = a == 1
+        false = a == 0
+        if kind == 'f':
+            false &= ~np.signbit(a)  # str(-0.0) is '-0.0'
+    return true, ~(true | false)
+
+
+def _check_array(a, rules):
+    '''
+    Returns the normalized array and [(mask, code, param)] of failed rules
+    in the order of execution, each row failing at most once
+    '''
+    failures = []
+    ok = np.ones(len(a), bool)
+
+    def fail(mask, code, param):
+        mask = mask & ok
+        if mask.any():
+            failures.append((mask, code, param))
+            ok[mask] = False
+
+    rget = rules.get
+    if 'type' in rules and a.dtype.kind not in _KINDS[rules['type']]:
+        fail(ok.copy(), 'type', rules['type'])
+
+    coerce = rget('coerce')
+    kind = a.dtype.kind
+    if coerce == 'int' or coerce == 'number' and kind in 'iub':
+        if kind == 'f':
+            finite = np.isfinite(a)
+            fail(~finite, 'coerce', 'int')
+            a = np.where(finite, a, 0).astype(np.int64)  # Truncates as int()
+        else:
+            a = a.astype(np.int64)
+    elif coerce == 'float':
+        a = a.astype(np.float64)
+    elif coerce == 'bool':
+        a, failed = _to_bool(a)
+        fail(failed, 'coerce', 'bool')
+
+    if rget('enum'):
+        fail(~np.isin(a, rules['enum']), 'enum', rules['enum'])
+    if rget('min') is not None:
+        fail(a < rules['min'], 'min', rules['min'])
+    if rget('max') is not None:
+        fail(a > rules['max'], 'max', rules['max'])
+    if rget('min_len') is not None or rget('max_len') is not None:
+        lengths = np.char.str_len(a)
+        if rget('min_len') is not None:
+            fail(lengths < rules['min_len'], 'min_len', rules['min_len'])
+        if rget('max_len') is not None:
+            fail(lengths > rules['max_len'], 'max_len', rules['max_len'])
+
+    return a, failures
+
+
+def _default(value, args):
+    if isinstance(value, str) and re.fullmatch('{.+}', value):
+        return args[value[1:-1]]
+    return value
+
+
+def validate_columns(validator, name, columns, args=None):
+    '''
+    Returns normalized columns and a list of (row, error) sorted by row.
+    Values of invalid rows in the returned columns are undefined.
+    '''
+    validator[name]  # Compile if lazy, generated code is the fallback
+    options = validator.schema_options(name)
+    schema = validator.flat_rules(name)
+    if (schema.get('type') != 'dict' or
+            any(map(schema.get, 'keys values pattern_items any_of one_of '
+                                'map enum min_len max_len post_coerce '
+                                'coerce nullable if_null'.split()))):
+        raise ValueError(f'Schema {name} is not a plain record schema')
+    inner = options.replace(**schema)  # Items are compiled with `options`
+    _locals = validator.__dict__
+
+    lengths = {len(col) for col in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError('Columns must have equal lengths')
+    n_rows = lengths.pop() if lengths else 0
+
+    # Items are moved onto their keys in turn, as by the generated code
+    out = {} if inner.purge_unknown else dict(columns)
+    errors = {}  # Row -> first error
+
+    def add_errors(rows, make_error):
+        for i in rows:
+            if i not in errors:
+                errors[i] = make_error()
+
+    known = set()
+    for key, item in (schema.get('items') or {}).items():
+        fname = (hash_obj(item) if isinstance(item, str) else
+                 hash_obj(item, options.__dict__))
+        rules = validator.flat_rules(item)
+        key_rules = rules if isinstance(rules, dict) else {}
+        synonyms = key_rules.get('synonyms') or []
+        known.update([key, *synonyms])
+        key_to = key_rules.get('rename', key)
+
+        src = next((k for k in [key, *synonyms] if k in columns), None)
+        if src is None:
+            if 'default' in key_rules:
+                out[key_to] = [_default(key_rules['default'], args)] * n_rows
+            elif key_rules.get('required', inner.require_all):
+                add_errors(range(n_rows), lambda: ValidationError(
+                    'required').at('.{}', key))
+            continue
+
+        col = out.pop(src, columns[src])
+        if rules == {}:
+            out[key_to] = col
+        elif rules is not NotImplemented and _vectorizable(col, rules):
+            out[key_to], failures = _check_array(col, rules)
+            for mask, code, param in failures:
+                add_errors(np.flatnonzero(mask).tolist(),
+                           lambda: ValidationError(code, param).at('.{}', src))
+        else:
+            # Items inlined into the record have no function of their own
+            f = (_locals.get(fname) or
+                 validator.compile_rules(item, options))
+            values = col.tolist() if np and isinstance(col, np.ndarray) else col
+            out[key_to] = normalized = []
+            append = normalized.append
+            for i, value in enumerate(values):
+                value, err = f(value, args)
+                append(value)
+                if err and i not in errors:
+                    errors[i] = err.at('.{}', src)
+
+    unknown = columns.keys() - known
+    if unknown and not inner.allow_unknown:
+        add_errors(range(n_rows),
+                   lambda: ValidationError('unknown_keys', set(unknown)))
+
+    errors = sorted(errors.items())
+    if not options.structured_errors:
+        errors = [(i, err.render('Input')) for i, err in errors]
+    return out, errors
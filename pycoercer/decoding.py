@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Validation during JSON decoding.
+
+Validator.loads(name, data) decodes a document with the scanner of the
+standard json module and validates it on the way. Large bodies are large
+because of their top-level containers, so those are decoded item by item:
+a root record holding records or lists, and lists of records or lists at
+the root or in items of the root record. Each of their items is decoded
+at once by the C scanner and validated right away, so decoding stops at
+the first invalid one. Rules of such a container as a whole (renames,
+defaults, required and unknown keys, enum, any_of...) run when it is
+closed, compiled without the rules of the values checked already. Deeper
+containers, items with synonyms and unknown keys are decoded at once too:
+stepping through them in Python costs more than early rejection saves.
+So do documents shorter than SMALL characters.
+
+Results are the same as of validator[name](json.loads(data)), except that
+of several errors the first one in the input is reported, rather than the
+first one in the schema. Like json.loads, only the last value of a repeated
+key counts: an invalid value of a key the rest of the input may repeat
+makes its record decoded at once.
+
+@author: mikhail-matrosov
+"""
+
+import json
+from json.decoder import WHITESPACE, JSONDecodeError, scanstring
+
+from pycoercer.code_generator import hash_obj
+from pycoercer.errors import ValidationError
+
+_decoder = json.JSONDecoder()
+_decode = _decoder.raw_decode
+_scan = _decoder.scan_once  # Skips the checks of raw_decode
+_ws = WHITESPACE.match
+_WS = frozenset(' \t\n\r')
+
+# Shorter documents are decoded at once, rejecting them early saves nothing
+SMALL = 16384
+
+# Rules of an item about its key rather than its value
+_KEY_RULES = {'rename', 'required', 'default'}
+
+# Rules not compiled into the function of a closed record or list
+_CLOSED_SKIP = {'title', 'description', 'examples', 'negative_examples',
+                'rules'}
+
+
+class _Invalid(Exception):
+    '''Stops decoding of an invalid document'''
+    def __init__(self, err):
+        super().__init__()
+        self.err = err
+
+
+class Node:
+    '''
+    How to decode a value of a schema.
+    func - validates a value decoded at once
+    kind - '{' or '[' if records or lists are decoded item by item
+    items - key -> Node of the items of records validated while decoding
+    values - Node of the values of lists
+    closed - validates a record or a list decoded item by item
+    '''
+    __slots__ = ('func', 'kind', 'items', 'values', 'closed')
+
+    def __init__(self, func):
+        self.func = func
+        self.kind = None
+
+
+def function(validator, rules, options):
+    '''Raw generated function of rules, compiled if there is none'''
+    func = validator.__dict__.get(hash_obj(rules, options.__dict__))
+    return func or validator.compile_rules(rules, options)
+
+
+def plan(validator, name):
+    '''Root Node of a named schema'''
+    node = Node(validator.__dict__[hash_obj(name)])
+    _expand(validator, node, validator.flat_rules(name),
+            validator.schema_options(name), 0)
+    return node
+
+
+def _node(validator, rules, options, depth):
+    if isinstance(rules, str):
+        node = Node(validator.__dict__[hash_obj(rules)])
+        options = validator.schema_options(rules)
+    else:
+        node = Node(function(validator, rules or {}, options))
+    _expand(validator, node, validator.flat_rules(rules), options, depth)
+    return node
+
+
+def _expand(validator, node, rules, options, depth):
+    '''
+    Decodes a record of `rules` at the root or a list at depth 0 or 1 item
+    by item if it holds records or lists
+    '''
+    if not isinstance(rules, dict) or rules.get('coerce'):
+        return
+    rtype = rules.get('type')
+    closed = {k: v for k, v in rules.items() if k not in _CLOSED_SKIP}
+
+    if rtype == 'dict' and rules.get('items') and depth == 0:
+        node.items = {}
+        closed['items'] = items = {}
+        flat = {key: validator.flat_rules(item)
+                for key, item in rules['items'].items()}
+        if not any(map(_container, flat.values())):
+            return  # Scalars are faster to decode and check at once
+        for key, item in rules['items'].items():
+            if isinstance(flat[key], dict) and 'synonyms' not in flat[key]:
+                node.items[key] = _node(validator, item, options, 1)
+                item = {k: v for k, v in flat[key].items()
+                        if k in _KEY_RULES}
+            items[key] = item  # With synonyms the key is known at the end
+    elif (rtype == 'list' and depth <= 1 and rules.get('keys') is None and
+            _container(validator.flat_rules(rules.get('values')))):
+        node.values = _node(validator, rules['values'], options, 2)
+        del closed['values']
+    else:
+        return
+
+    node.closed = function(validator, closed, options)
+    node.kind = '{' if rtype == 'dict' else '['
+
+
+def _skip(s, i):
+    '''End of whitespace at s[i], a single space is the common case'''
+    if s[i:i + 1] in _WS:
+        i += 1
+        if s[i:i + 1] in _WS:
+            i = _ws(s, i).end()
+    return i
+
+
+def _container(rules):
+    return isinstance(rules, dict) and rules.get('type') in ('dict', 'list')
+
+
+def _no_value(s, stop):
+    '''Error of the scanner stopped at a position'''
+    return JSONDecodeError('Expecting value', s, stop.value)
+
+
+def _value(s, i, node, args):
+    '''Decodes and validates a value starting at s[i], returns its end'''
+    kind = node.kind
+    if kind is None or not s.startswith(kind, i):
+        try:
+            o, i = _scan(s, i)
+        except StopIteration as e:
+            raise _no_value(s, e) from None
+        o, err = node.func(o, args)
+    else:
+        o, i = (_record if kind == '{' else _list)(s, i + 1, node, args)
+        o, err = node.closed(o, args)
+    if err:
+        raise _Invalid(err)
+    return o, i
+
+
+def _record(s, i, node, args):
+    out = {}
+    items = node.items
+    start = i - 1
+    i = _skip(s, i)
+    if s.startswith('}', i):
+        return out, i + 1
+    while True:
+        if not s.startswith('"', i):
+            raise JSONDecodeError(
+                'Expecting property name enclosed in double quotes', s, i)
+        key, i = scanstring(s, i + 1)
+        i = _skip(s, i)
+        if not s.startswith(':', i):
+            raise JSONDecodeError("Expecting ':' delimiter", s, i)
+        i = _skip(s, i + 1)
+
+        item = items.get(key)
+        if item is None:
+            out[key], i = _decode(s, i)
+        else:
+            try:
+                out[key], i = _value(s, i, item, args)
+            except _Invalid as e:
+                if _repeated(s, i, key):  # Only the last value counts
+                    return _whole(s, start, node, args)
+                e.err.at('.{}', key)
+                raise
+
+        i = _skip(s, i)
+        if s.startswith('}', i):
+            return out, i + 1
+        if not s.startswith(',', i):
+            raise JSONDecodeError("Expecting ',' delimiter", s, i)
+        i = _skip(s, i + 1)
+
+
+def _repeated(s, i, key):
+    '''Whether `key` may occur again in s[i:], escapes could hide it'''
+    return (s.find(json.dumps(key, ensure_ascii=False), i) != -1 or
+            s.find('\\', i) != -1)
+
+
+def _whole(s, start, node, args):
+    '''Decodes the record at s[start] at once and validates its items'''
+    out, i = _decode(s, start)
+    items = node.items
+    for key, o in out.items():
+        item = items.get(key)
+        if item is not None:
+            o, err = item.func(o, args)
+            if err:
+                raise _Invalid(err.at('.{}', key))
+            out[key] = o
+    return out, i
+
+
+def _list(s, i, node, args):
+    out = []
+    append = out.append
+    values = node.values
+    func = values.kind is None and values.func  # Values decoded at once
+    i = _skip(s, i)
+    if s.startswith(']', i):
+        return out, i + 1
+    while True:
+        if func:
+            try:
+                o, i = _scan(s, i)
+            except StopIteration as e:
+                raise _no_value(s, e) from None
+            o, err = func(o, args)
+            if err:
+                raise _Invalid(err.at('[{}]', len(out)))
+        else:
+            try:
+                o, i = _value(s, i, values, args)
+            except _Invalid as e:
+                e.err.at('[{}]', len(out))
+                raise
+        append(o)
+
+        c = s[i:i + 1]
+        if c in _WS:
+            i = _skip(s, i)
+            c = s[i:i + 1]
+        if c == ',':
+            i += 1
+            if s[i:i + 1] in _WS:
+                i = _skip(s, i)
+        elif c == ']':
+            return out, i + 1
+        else:
+            raise JSONDecodeError("Expecting ',' delimiter", s, i)
+
+
+def loads(validator, name, node, data, args=None):
+    '''(doc, None) or (None, err), node - plan of the schema'''
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode(json.detect_encoding(data), 'surrogatepass')
+    try:
+        if data.startswith('\ufeff'):
+            raise JSONDecodeError(
+                'Unexpected UTF-8 BOM (decode using utf-8-sig)', data, 0)
+        i = _skip(data, 0)
+        if len(data) < SMALL:
+            doc, i = _decode(data, i)
+            doc, err = node.func(doc, args)
+            if err:
+                raise _Invalid(err)
+        else:
+            doc, i = _value(data, i, node, args)
+        i = _skip(data, i)
+        if i != len(data):
+            raise JSONDecodeError('Extra data', data, i)
+        return doc, None
+    except JSONDecodeError as e:
+        err = ValidationError('json', str(e))
+    except _Invalid as e:
+        err = e.err
+    return None, (err if validator.schema_options(name).structured_errors
+                  else err.render('Input'))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Ahead-of-time export of a Validator into a python module.
+
+The module contains the generated functions as plain python code, so
+importing it compiles nothing at runtime and gets .pyc caching for free.
+
+@author: mikhail-matrosov
+"""
+
+import ast
+import pickle
+import re
+from types import BuiltinMethodType
+
+import pycoercer
+from pycoercer import cache
+
+HEADER = '''\
+# Generated by pycoercer {version} with Validator.export_module().
+# Do not edit.
+
+import pickle
+import re
+
+from pycoercer import Options, Validator
+from pycoercer.cache import restore
+
+_code = []
+'''
+
+FOOTER = '''
+validator = Validator(options=Options(**{options}))
+restore(validator, {{
+    'functions': {functions},
+    'stubs': {stubs},
+    'helpers': {{{helpers}}},
+    'schemas': {{{schemas}}},
+    'registry': {registry},
+    'deps': {deps},
+    'options': {{{schema_options}}},
+    'memos': {memos}
+}})
+'''
+
+
+def as_source(obj):
+    '''Python expression creating a copy of obj'''
+    if isinstance(obj, BuiltinMethodType) and obj.__self__ is not None:
+        return f'{as_source(obj.__self__)}.{obj.__name__}'
+    if isinstance(obj, re.Pattern):
+        return f're.compile({obj.pattern!r}, {obj.flags})'
+    try:
+        src = repr(obj)
+        if ast.literal_eval(src) == obj:
+            return src
+    except Exception:  # Not a literal, or a recursive object
+        pass
+    return f'pickle.loads({pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)!r})'
+
+
+def export_module(validator, path):
+    fresh = type(validator)().__dict__
+    _locals = validator.__dict__
+    before = {k: v for k, v in _locals.items()
+              if k in fresh or k.startswith('coerce_')}
+    entry = cache.snapshot(validator, before, validator._schemas)
+
+    chunks = [HEADER.format(version=pycoercer.__version__)]
+    functions = []
+    for i, (keys, name, code, defaults, src, schema, guarded) in enumerate(
+            entry['functions']):
+        chunks.append(f'\n\n{src}\n\n\n_code.append({name}.__code__)\n'
+                      f'del {name}\n')
+        functions.append(f'({keys!r}, {name!r}, _code[{i}], {defaults!r}, '
+                         f'{src!r}, {as_source(schema)}, {guarded!r})')
+
+    chunks.append(FOOTER.format(
+        options=repr(validator.options.__dict__),
+        functions='[\n        ' + ',\n        '.join(functions) + '\n    ]',
+        stubs=repr(entry['stubs']),
+        helpers=', '.join(f'{k!r}: {as_source(v)}'
+                          for k, v in entry['helpers'].items()),
+        schemas=', '.join(f'{k!r}: {as_source(v)}'
+                          for k, v in entry['schemas'].items()),
+        registry=repr(entry['registry']),
+        deps=repr(entry['deps']),
+        schema_options=', '.join(f'{k!r}: {v!r}'
+                                 for k, v in entry['options'].items()),
+        memos=repr(entry['memos'])))
+
+    with open(path, 'w') as f:
+        f.write(''.join(chunks))
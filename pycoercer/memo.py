@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Memoization of custom coercers.
+
+A coercer with a memo is called through Memo: results are kept in an LRU
+keyed by the type and the value of the input, so 1, 1.0 and True are
+cached separately. Unhashable inputs are passed to the coercer as is.
+Failed coercions are not cached. A memoized coercer must not depend on
+`args`. Coroutine coercers are not memoized.
+
+@author: mikhail-matrosov
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class Memo:
+    '''Bounded LRU of the results of one coercer with hit/miss counters'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, func, value, args):
+        try:
+            key = (type(value), value)
+            with self._lock:
+                result = self._data[key]
+                self._data.move_to_end(key)
+                self.hits += 1
+            return result
+        except KeyError:
+            pass
+        except TypeError:  # Unhashable
+            return func(value, args)
+
+        result = func(value, args)
+        with self._lock:
+            self.misses += 1
+            self._data[key] = result
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Bulk validation in a pool of worker processes.
+
+Every worker gets its own copy of the validator: inherited when processes
+are forked, pickled and compiled again otherwise (see
+Validator.__getstate__). Documents are sent in chunks validated with
+Validator.validate_many, results come back in the input order.
+
+@author: mikhail-matrosov
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+_validator = None  # Validator of a worker process
+
+
+def _init_worker(validator):
+    global _validator
+    _validator = validator
+
+
+def _validate_chunk(name, args, docs):
+    return _validator.validate_many(name, docs, args)
+
+
+def _chunks(docs, size):
+    docs = iter(docs)
+    chunk = list(islice(docs, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(docs, size))
+
+
+def validate_parallel(validator, name, docs, workers=None, chunksize=1000,
+                      args=None):
+    '''
+    Same results as validator.validate_many(name, docs, args).
+    workers - number of processes, defaults to the number of CPUs.
+    '''
+    validator[name]  # Compile if lazy, before workers copy the validator
+    out = []
+    errors = []
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(validator,)) as pool:
+        results = pool.map(partial(_validate_chunk, name, args),
+                           _chunks(docs, chunksize))
+        for chunk_out, chunk_errors in results:
+            errors.extend((i + len(out), err) for i, err in chunk_errors)
+            out.extend(chunk_out)
+    return out, errors
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Counters of code compiled with Options(profile=True).
+
+Every generated function and every rule in it (type, coerce, regex,
+items, enum, ...) gets a Stat counting calls, failures, time and failed
+(code, path) pairs, path being relative to the checked value. Times are
+inclusive: a rule calling nested schemas counts their time too. Counters
+are not locked and may miss updates from concurrent threads. Checkers of
+Validator.is_valid are never instrumented.
+
+@author: mikhail-matrosov
+"""
+
+import re
+from time import perf_counter_ns
+
+
+class Stat:
+    '''Calls, failures and time of a generated function or a rule'''
+    __slots__ = ('label', 'rule', 'calls', 'failures', 'ns', 'errors')
+
+    def __init__(self, label, rule=None):
+        self.label = label  # Schema name or repr of the rules
+        self.rule = rule  # None for the whole function
+        self.reset()
+
+    def __reduce__(self):  # Copies in caches and exports start from zero
+        return Stat, (self.label, self.rule)
+
+    def reset(self):
+        self.calls = self.failures = self.ns = 0
+        self.errors = {}  # (code, path) -> count
+
+    def ok(self, t0, o):
+        self.ns += perf_counter_ns() - t0
+        self.calls += 1
+        return o
+
+    def fail(self, t0, err):
+        self.ns += perf_counter_ns() - t0
+        self.calls += 1
+        self.failures += 1
+        key = err.code, err.path
+        self.errors[key] = self.errors.get(key, 0) + 1
+        return err
+
+    def stats(self):
+        return {'calls': self.calls, 'failures': self.failures,
+                'ns': self.ns, 'errors': dict(self.errors)}
+
+
+def profiled(lines, stat):
+    '''
+    Lines of generated code with returns counted by `stat`, which has to be
+    started with `{stat}_t = _ns()`
+    '''
+    t = stat + '_t'
+    for line in lines:
+        m = re.match(r'(\s*)return (.*), None$', line)
+        if m:
+            yield f'{m[1]}return {stat}.ok({t}, {m[2]}), None'
+            continue
+        m = re.match(r'(\s*)return None, (.*)$', line)
+        if m:
+            yield f'{m[1]}return None, {stat}.fail({t}, {m[2]})'
+        else:
+            yield line
+
+
+def collect(objects):
+    '''
+    Schema label -> stats of its function with stats of its rules in
+    'rules'. Counters that were never hit are left out, those with the
+    same labels are summed.
+    '''
+    result = {}
+    for stat in objects:
+        if not isinstance(stat, Stat) or not stat.calls:
+            continue
+        entry = result.get(stat.label)
+        if entry is None:
+            entry = result[stat.label] = {**Stat(None).stats(), 'rules': {}}
+        if stat.rule is not None:
+            entry = entry['rules'].setdefault(stat.rule, Stat(None).stats())
+        entry['calls'] += stat.calls
+        entry['failures'] += stat.failures
+        entry['ns'] += stat.ns
+        for key, n in stat.errors.items():
+            entry['errors'][key] = entry['errors'].get(key, 0) + n
+    return result
@@ -5,7 +5,13 @@ Created on Fri Sep 20 12:37:07 2019
 @author: mikhail-matrosov
 """
 
+import threading
+
+from pycoercer import (cache, columnar, decoding, export, parallel,
+                       profile, shared, streaming)
 from pycoercer.basic_validator import BasicValidator
+from pycoercer.code_generator import (async_name, checker_name,
+                                      declared_memos, hash_obj, uses_async)
 
 
 class Options():
@@ -16,13 +22,34 @@ class Options():
                  break_loops=True,
                  load_as_jsonschema=False,
                  validate_schemas=True,
+                 inline_limit=20,
+                 inplace=False,
+                 structured_errors=False,
+                 profile=False,
+                 specialize=0,
+                 max_shapes=4,
                  **_):
         self.allow_unknown = allow_unknown
         self.purge_unknown = purge_unknown
         self.require_all = require_all
-        self.break_loops = break_loops  # Makes Phimera ~10-15% slower
+        # Guard recursive schemas against cyclic documents, makes them ~10-15%
+        # slower. Flat schemas are never guarded.
+        self.break_loops = break_loops
         self.load_as_jsonschema = load_as_jsonschema
         self.validate_schemas = validate_schemas
+        # Max lines of a leaf rule set to inline into the parent, 0 to disable
+        self.inline_limit = inline_limit
+        # Normalize dicts and lists by writing into the input (see docs)
+        self.inplace = inplace
+        # Return pycoercer.errors.ValidationError instead of strings
+        self.structured_errors = structured_errors
+        # Count calls, failures and time of functions and rules, see stats()
+        self.profile = profile
+        # Compile dict rules for a key set of the input after that many
+        # calls with it, 0 to disable. At most max_shapes key sets per rule
+        # set, see pycoercer.shapes.
+        self.specialize = specialize
+        self.max_shapes = max_shapes
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
@@ -34,29 +61,413 @@ class Options():
         return Options(**data)
 
 
+class OnDemand(dict):
+    '''Functions derived from named schemas, compiled on first access'''
+    def __init__(self, build):
+        super().__init__()
+        self.build = build
+
+    def __missing__(self, name):
+        return self.build(name)
+
+
 class Validator(BasicValidator):
-    def __init__(self, schemas: dict = None, options=None, **kwargs):
+    def __init__(self, schemas: dict = None, options=None, cache_dir=None,
+                 lazy=False, share_code=False, **kwargs):
+        '''
+        cache_dir - directory to store compiled code in. Updates with the
+        same schemas, options and pycoercer version are loaded from it
+        instead of being generated again.
+        lazy - only record schemas in update(), compile them with their
+        dependencies on first access. Examples are tested at that time too.
+        share_code - share compiled code and immutable helpers with other
+        validators of the process, see pycoercer.shared.
+        '''
         super().__init__()
+        self._share_code = share_code
         self.registry = {}
+        self.cache_dir = cache_dir
+        self.lazy = lazy
+        self._pending = {}  # Schemas waiting for compilation -> options
+        self._options = {}  # Compiled schemas -> options
+        self._deps = {}  # Compiled schemas -> named schemas they use
+        self.checker = OnDemand(self._build_checker)  # f(doc, args) -> bool
+        # Name -> async f(doc, args) or None if the schema has no async parts
+        self.coroutine = OnDemand(self._build_coroutine)
+        self._batch = {}  # Name -> f(docs, args) for validate_many
+        self._plans = {}  # Name -> decoding.Node for loads
+        self._lock = threading.RLock()  # Code generation state is shared
         self.options = (options or Options()).replace(**kwargs)
 
         if schemas:
             self.update(schemas)
 
+    def __getstate__(self):
+        '''
+        Generated code can't be pickled: store what it is generated from,
+        schemas with their options and coerce_* functions
+        '''
+        return {
+            'options': self.options,
+            'cache_dir': self.cache_dir,
+            'lazy': self.lazy,
+            'share_code': self._share_code,
+            'coercers': {k: v for k, v in self.__dict__.items()
+                         if k.startswith('coerce_')},
+            'memos': {name: memo.maxsize
+                      for name, memo in self._memos.items()},
+            'schemas': self._schemas,
+            'schema_options': {name: self.schema_options(name)
+                               for name in self._schemas},
+            'compiled': list(self.registry),
+        }
+
+    def __setstate__(self, state):
+        Validator.__init__(self, options=state['options'],
+                           cache_dir=state['cache_dir'], lazy=state['lazy'],
+                           share_code=state['share_code'])
+        self.__dict__.update(state['coercers'])
+        for name, maxsize in state['memos'].items():
+            self.memo(name, maxsize)
+        self._schemas.update(state['schemas'])
+        self._pending.update(state['schema_options'])
+        self.warmup(state['compiled'])
+
     def __getitem__(self, k):
+        try:
+            return self.registry[k]
+        except KeyError:
+            if k not in self._pending:
+                raise
+        self.warmup([k])
         return self.registry[k]
 
     def __setitem__(self, key, schema: dict):
         self.update({key: schema})
 
+    def schema_options(self, name):
+        return (self._options.get(name) or self._pending.get(name) or
+                self.options)
+
+    def dependency_graph(self):
+        '''Compiled schemas -> set of named schemas they use directly'''
+        return {name: set(refs) for name, refs in self._deps.items()}
+
+    def dependents(self, names):
+        '''Compiled schemas that use any of `names`, directly or not'''
+        result = set()
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            for k, refs in self._deps.items():
+                if name in refs and k not in result:
+                    result.add(k)
+                    todo.append(k)
+        return result
+
+    def register_coercer(self, name, func, memo=None):
+        '''
+        Sets coerce_<name> = func(value, args). memo - max number of results
+        to cache, see pycoercer.memo. Compiled schemas are rebuilt to use
+        a new memo.
+        '''
+        setattr(self, 'coerce_' + name, func)
+        if memo:
+            new = name not in self._memos
+            self.memo(name, memo)
+            if new:  # Compiled code calls the coercer directly
+                self._build(list(self.registry))
+
+    def memo_stats(self):
+        '''Coercer name -> hits, misses, size and maxsize of its memo'''
+        return {name: memo.stats() for name, memo in self._memos.items()}
+
+    def clear_memos(self, names=None):
+        '''Empties memos of the coercers (all by default)'''
+        for name in self._memos if names is None else names:
+            self._memos[name].clear()
+
+    def stats(self):
+        '''
+        Counters of schemas compiled with profile=True: schema name (repr of
+        the rules for nested ones) -> calls, failures, ns, errors
+        {(code, path): count} and the same for each rule in 'rules'.
+        See pycoercer.profile.
+        '''
+        return profile.collect(list(self.__dict__.values()))
+
+    def reset_stats(self):
+        for v in list(self.__dict__.values()):
+            if isinstance(v, profile.Stat):
+                v.reset()
+
+    def memory_report(self):
+        '''
+        Counts of generated functions and helpers with bytes retained by
+        this validator alone and bytes shared with other validators
+        '''
+        return shared.memory_report(self)
+
+    def specialize(self, rules, options, keys):
+        '''Compiles dict rules for inputs with `keys`, see pycoercer.shapes'''
+        with self._lock:
+            options_backup = self.options
+            self.options = options
+            try:
+                return self.generate_specialized(rules, options, keys)
+            finally:
+                self.options = options_backup
+
+    def compile_rules(self, rules, options=None):
+        '''
+        Raw function of anonymous rules: f(doc, args) -> (doc, err) with a
+        structured err
+        '''
+        options = options or self.options
+        with self._lock:
+            options_backup = self.options
+            self.options = options
+            try:
+                return self.generate_function(rules, options, None)
+            finally:  # even if exception
+                self._positive_examples.clear()
+                self._negative_examples.clear()
+                self.options = options_backup
+
+    def is_valid(self, name, doc, args=None):
+        '''
+        Checks doc against a schema without normalizing it or formatting
+        errors. Faster than self[name] when only a yes/no answer is needed.
+        '''
+        return self.checker[name](doc, args)
+
+    def validate_many(self, name, docs, args=None):
+        '''
+        Validates an iterable of documents in a single generated loop.
+        Returns a list of normalized documents, None for invalid ones,
+        and a list of (index, error) for the invalid ones.
+        '''
+        try:
+            batch = self._batch[name]
+        except KeyError:
+            self[name]  # Compile if lazy
+            with self._lock:
+                batch = self._batch[name] = self.generate_batch(name)
+
+        out, errors = batch(docs, args)
+        if errors and not self.schema_options(name).structured_errors:
+            errors = [(i, err.render('Input')) for i, err in errors]
+        return out, errors
+
+    def loads(self, name, data, args=None):
+        '''
+        Decodes a JSON document (str or bytes) validating it on the way,
+        invalid documents are decoded up to their first error only.
+        Returns (doc, err) as self[name](json.loads(data), args) would.
+        See pycoercer.decoding.
+        '''
+        try:
+            plan = self._plans[name]
+        except KeyError:
+            self[name]  # Compile if lazy
+            with self._lock:
+                plan = self._plans[name] = decoding.plan(self, name)
+        return decoding.loads(self, name, plan, data, args)
+
+    def validate_columns(self, name, columns, args=None):
+        '''
+        Validates a batch of records stored as a dict of equal-length
+        columns (lists or NumPy arrays) against a 'type': 'dict' schema.
+        Returns normalized columns and a list of (row, error).
+        See pycoercer.columnar.
+        '''
+        return columnar.validate_columns(self, name, columns, args)
+
+    def validate_stream(self, name, source, args=None, values=False):
+        '''
+        Lazily validates an NDJSON file object, an iterable of bytes chunks
+        or an iterable of documents, yielding (doc, err) pairs.
+        values=True streams the items of a 'type': 'list' schema instead.
+        See pycoercer.streaming.
+        '''
+        return streaming.validate_stream(self, name, source, args, values)
+
+    def split_stream(self, name, source, valid, invalid, args=None,
+                     values=False):
+        '''
+        Like validate_stream, but calls valid(doc) or invalid(index, err).
+        Returns counts of valid and invalid documents.
+        '''
+        return streaming.split_stream(self, name, source, valid, invalid,
+                                      args, values)
+
+    def validate_parallel(self, name, docs, workers=None, chunksize=1000,
+                          args=None):
+        '''
+        validate_many in a pool of `workers` processes, `chunksize`
+        documents per task. See pycoercer.parallel.
+        '''
+        return parallel.validate_parallel(self, name, docs, workers,
+                                          chunksize, args)
+
+    async def validate_async(self, name, doc, args=None):
+        '''
+        Validates doc with a schema whose coerce_* functions may be
+        coroutines. Independent items of dicts and lists are awaited
+        concurrently. Schemas without coroutine coercers run the sync code.
+        '''
+        func = self.coroutine[name]
+        if func is None:
+            return self[name](doc, args)
+        doc, err = await func(doc, args)
+        if err and not self.schema_options(name).structured_errors:
+            err = err.render('Input')
+        return doc, err
+
+    def validate_stream_async(self, name, source, args=None, concurrency=16):
+        '''
+        Async iterator of (doc, err) for an async iterable of documents or
+        any source of validate_stream, validating up to `concurrency`
+        documents at a time. Results are in the input order.
+        '''
+        return streaming.validate_stream_async(self, name, source, args,
+                                               concurrency)
+
+    def _build_checker(self, name):
+        if name not in self._schemas:
+            raise KeyError(name)
+        self.warmup([name])
+
+        with self._lock:
+            if name in self.checker:  # Built by another thread
+                return self.checker[name]
+            options_backup = self.options
+            self.options = self.schema_options(name).replace(inplace=False)
+            try:
+                func = self.checker[name] = self.generate_function(
+                    self._schemas[name], self.options, name, checker=True)
+            finally:  # even if exception
+                self._positive_examples.clear()
+                self._negative_examples.clear()
+                self.options = options_backup
+        return func
+
+    def _build_coroutine(self, name):
+        if name not in self._schemas:
+            raise KeyError(name)
+        self.warmup([name])
+
+        with self._lock:
+            if name in self.coroutine:  # Built by another thread
+                return self.coroutine[name]
+            func = None
+            is_async = uses_async(self, name)
+            self._uses_async.clear()  # Memo of a single generation
+            if is_async:
+                options_backup = self.options
+                self.options = self.schema_options(name)
+                try:
+                    func = self.generate_function(
+                        self._schemas[name], self.options, name,
+                        coroutine=True)
+                finally:  # even if exception
+                    self._positive_examples.clear()
+                    self._negative_examples.clear()
+                    self.options = options_backup
+            self.coroutine[name] = func
+        return func
+
+    def _drop_derived(self, names):
+        '''
+        Checkers, batches, coroutines and decoding plans of changed schemas
+        are rebuilt on next use
+        '''
+        _locals = self.__dict__
+        for name in names:
+            self.checker.pop(name, None)
+            self._batch.pop(name, None)
+            self._plans.pop(name, None)
+            self.coroutine.pop(name, None)
+            h = hash_obj(name)
+            if checker_name(h) in _locals:
+                _locals[checker_name(h)] = self.checker_stub(name)
+            if async_name(h) in _locals:
+                _locals[async_name(h)] = self.coroutine_stub(name)
+
+    def export_module(self, path):
+        '''
+        Writes a self-contained python module with the generated code.
+        Importing it yields `validator` - a copy of self with the same
+        registry, no code generation happens at import time.
+        Custom coercers are not exported: set them on the imported validator.
+        '''
+        self.warmup()
+        export.export_module(self, path)
+
+    def warmup(self, names=None):
+        '''
+        Compiles pending schemas (all by default) and the schemas they use.
+        Call before forking workers to share the code between them.
+        '''
+        self._build(n for n in (self._pending if names is None else names)
+                    if n in self._pending)
+
+    def _build(self, names):
+        '''
+        Compiles schemas with their pending dependencies, then tests examples
+        '''
+        with self._lock:
+            todo = list(names)
+            built = []
+            options_backup = self.options
+            try:
+                visited = set()
+                for name in todo:
+                    for coercer, maxsize in declared_memos(self, name,
+                                                           visited):
+                        self.memo(coercer, maxsize)
+                while todo:
+                    name = todo.pop()
+                    if name in built:
+                        continue
+                    options = (self._pending.pop(name, None) or
+                               self._options[name])
+                    self.options = options
+                    self.registry[name] = self.generate_function(
+                        self._schemas[name], options, name)
+                    self._options[name] = options
+                    self._deps[name] = frozenset(self._refs)
+                    built.append(name)
+                    todo.extend(ref for ref in self._refs
+                                if ref in self._pending)
+                self._drop_derived(built)
+
+                if any(self._options[name].validate_schemas
+                       for name in built):
+                    self._test_examples()
+            finally:  # even if exception
+                self._positive_examples.clear()
+                self._negative_examples.clear()
+                self.options = options_backup
+            return built
+
     def update(self, schemas: dict, options=None, **kwargs):
         options = (options or self.options).replace(**kwargs)
-        self.options, options_backup = options, self.options
 
         if options.load_as_jsonschema:
             schemas = {k: {'type': 'dict', 'schema': v}
                        for k, v in schemas.items()}
 
+        if self.cache_dir:
+            key = cache.cache_key(self, schemas, options)
+            entry = cache.load(self.cache_dir, key)
+            if entry:
+                cache.restore(self, entry)
+                for name in entry['registry']:
+                    self._pending.pop(name, None)
+                return
+            before = self.__dict__.copy()
+
         # Validate input schemas
         if options.validate_schemas:
             schemas, err = pycoercer_schema_validator(schemas)
@@ -64,22 +475,21 @@ class Validator(BasicValidator):
                 raise ValueError(err)
 
         self._schemas.update(schemas)
+        self._pending.update((name, options) for name in schemas)
 
-        # Code generation
-        self.registry.update({
-            name: self.generate_function(schema, options, name)
-            for name, schema in schemas.items()
-        })
-
-        # Validate examples
-        try:
-            if options.validate_schemas:
-                self._test_examples()
-        finally:  # even if exception
-            self._positive_examples.clear()
-            self._negative_examples.clear()
+        # Compiled schemas that use the new ones must be rebuilt: they may
+        # depend on their rules (rename, synonyms, default, inlined code...)
+        affected = self.dependents(schemas) - set(schemas)
+        if self.lazy:
+            # Already compiled schemas may be in use, replace them right away
+            names = [name for name in schemas if name in self.registry]
+        else:
+            names = list(schemas)
+        built = self._build([*names, *affected])
 
-        self.options = options_backup
+        if self.cache_dir and not self.lazy:
+            cache.dump(self.cache_dir, key,
+                       cache.snapshot(self, before, schemas, built))
 
 
 pycoercer_schema = {
@@ -170,7 +580,9 @@ pycoercer_schema = {
                 'values': 'obj',
                 'synonyms': ['anyOf', 'anyof']
             },
-            'post_coerce': 'str'
+            'post_coerce': 'str',
+            'memo': {'type': 'int', 'min': 1},
+            'discriminator': 'str'
 
             # todo: if_invalid
         }
@@ -197,6 +609,7 @@ _pcsv = Validator(
     require_all=False,
     break_loops=True,
     load_as_jsonschema=False,
-    validate_schemas=False)
+    validate_schemas=False,
+    inplace=False)  # Must not change schemas of the user
 
 pycoercer_schema_validator = _pcsv['obj_dict']
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Functions specialized for the key sets of dict inputs.
+
+With Options(specialize=n), a 'type': 'dict' rule set with items counts
+the key sets of its inputs. After n calls with the same keys it compiles
+a function for them: items are read without presence tests, missing
+items get their defaults or errors right away and, unless the keys have
+unknown ones to check, unknown keys are not looked for. The generic
+function calls it when `o.keys() == keys`, which for most other inputs
+is a length check. At most options.max_shapes functions are compiled per
+rule set, later key sets use the generic code.
+
+@author: mikhail-matrosov
+"""
+
+
+class Shapes:
+    '''Specialized functions of a rule set and counts of key sets'''
+    def __init__(self, rules, options):
+        self.rules = rules
+        self.options = options
+        self.funcs = []  # [(keys, func)], replaced as a whole for threads
+        self.counts = {}  # Keys -> calls, until specialized
+
+    def __reduce__(self):  # Copies compile their own functions
+        return Shapes, (self.rules, self.options)
+
+    def observe(self, o, validator):
+        '''Counts keys of a dict handled by the generic function'''
+        options = self.options
+        if len(self.funcs) >= options.max_shapes:
+            return
+        keys = frozenset(o)
+        n = self.counts.get(keys, 0) + 1
+        if n < options.specialize:
+            if len(self.counts) >= 16 * options.max_shapes:
+                self.counts.clear()  # Keys are too diverse, start over
+            self.counts[keys] = n
+            return
+
+        self.counts.pop(keys, None)
+        func = validator.specialize(self.rules, options, keys)
+        funcs = self.funcs  # Other threads may have added some
+        if (len(funcs) < options.max_shapes and
+                all(k != keys for k, _ in funcs)):
+            self.funcs = [*funcs, (keys, func)]
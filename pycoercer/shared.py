@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Generated code and helpers shared by validators of a process.
+
+Functions of a Validator are bound to its namespace, but their code objects
+are not: with Validator(share_code=True), generated source is compiled once
+per process and every validator generating the same source execs that code
+object and keeps the same source string. Frozensets and compiled regexes
+stored for generated code are shared the same way. Validators restored from
+cache_dir share what they load too. The cache holds everything it has seen
+until clear().
+
+Validator.memory_report() tells what an instance retains alone and what it
+shares. Sizes are shallow sums of sys.getsizeof, so approximate.
+
+@author: mikhail-matrosov
+"""
+
+import re
+import sys
+from types import CodeType, FunctionType
+
+from pycoercer.shapes import Shapes
+
+_codes = {}  # Source -> (source, code of the function)
+_helpers = {}  # Helper name -> helper
+
+# Names of generated functions and helpers: checkers, batches, coroutines,
+# profile stats and shapes have prefixes
+_GENERATED = re.compile(r'_(?:is|many|async|p|s)?[0-9a-f]{16}')
+
+
+def code(src, compiled=None):
+    '''
+    (source, code) of the function defined by src shared by the process,
+    compiled if needed
+    '''
+    entry = _codes.get(src)
+    if entry is None:
+        if compiled is None:
+            module = compile(src, '<string>', 'exec')
+            compiled = next(c for c in module.co_consts
+                            if isinstance(c, CodeType))
+        entry = _codes.setdefault(src, (src, compiled))
+    return entry
+
+
+def immutable(obj):
+    '''Helpers safe to share: frozensets and methods of compiled regexes'''
+    return (type(obj) is frozenset or
+            isinstance(getattr(obj, '__self__', None), re.Pattern))
+
+
+def helper(name, obj):
+    '''The shared copy of a helper'''
+    return _helpers.setdefault(name, obj) if immutable(obj) else obj
+
+
+def clear():
+    '''Forgets shared code and helpers, validators keep what they use'''
+    _codes.clear()
+    _helpers.clear()
+
+
+def stats():
+    return {'codes': len(_codes), 'helpers': len(_helpers)}
+
+
+def _code_size(code):
+    size = sys.getsizeof(code) + sys.getsizeof(code.co_code)
+    for const in code.co_consts:
+        size += (_code_size(const) if isinstance(const, CodeType) else
+                 sys.getsizeof(const))
+    return size
+
+
+def _size(obj):
+    '''Size of obj and of the items it holds directly'''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(map(sys.getsizeof, obj.values()))
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(map(sys.getsizeof, obj))
+    return size
+
+
+def memory_report(validator):
+    '''
+    Generated functions and helpers of a validator with the bytes they
+    retain alone and the bytes of the code, sources and helpers shared
+    with other validators
+    '''
+    shared_codes = {id(code): src for src, code in _codes.values()}
+    shared_helpers = set(map(id, _helpers.values()))
+    functions = {}
+    helpers = {}
+    for k, v in validator.__dict__.items():
+        if not _GENERATED.fullmatch(k):
+            continue
+        if hasattr(v, 'src'):
+            functions[id(v)] = v
+        elif isinstance(v, Shapes):
+            helpers[id(v)] = v
+            functions.update((id(f), f) for _, f in v.funcs)
+        elif not isinstance(v, FunctionType):  # Stubs are not counted
+            helpers[id(v)] = v
+
+    own = shared = 0
+    for func in functions.values():
+        raw = getattr(func, '__wrapped__', func)
+        own += sys.getsizeof(func) + sys.getsizeof(func.__dict__)
+        if func is not raw:  # Guarded by a loopbreaker
+            own += sys.getsizeof(raw)
+        if shared_codes.get(id(raw.__code__)) is func.src:
+            shared += _code_size(raw.__code__) + sys.getsizeof(func.src)
+        else:
+            own += _code_size(raw.__code__) + sys.getsizeof(func.src)
+    for obj in helpers.values():
+        if id(obj) in shared_helpers:
+            shared += _size(obj)
+        else:
+            own += _size(obj)
+
+    return {'functions': len(functions), 'helpers': len(helpers),
+            'bytes': own, 'shared_bytes': shared}
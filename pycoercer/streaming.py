@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Lazy validation of document streams.
+
+A source is a file object with one JSON document per line (NDJSON, text
+or binary), an iterable of bytes chunks split at arbitrary points, or an
+iterable of already decoded documents. Documents are read, decoded and
+validated one at a time, so memory use does not depend on the stream
+length. With values=True a stream holds the items of a top-level
+'type': 'list' schema rather than whole documents.
+validate_stream_async also takes async iterables of documents and
+validates several documents at a time with Validator.validate_async.
+
+@author: mikhail-matrosov
+"""
+
+import asyncio
+import json
+from collections import deque
+from itertools import chain
+
+from pycoercer.code_generator import hash_obj
+from pycoercer.errors import ValidationError
+
+# List rules that do not need the whole list
+_STREAM_RULES = {'type', 'values', 'title', 'description', 'examples',
+                 'negative_examples'}
+
+
+def _lines(chunks):
+    '''Splits a stream of bytes chunks into lines'''
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    yield tail
+
+
+def _decode(lines):
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line), None
+            except ValueError as e:
+                yield None, ValidationError('json', str(e))
+
+
+def documents(source):
+    '''Iterates over (doc, err) with err set for lines that are not JSON'''
+    if hasattr(source, 'read'):
+        return _decode(source)
+    source = iter(source)
+    for first in source:
+        source = chain([first], source)
+        if isinstance(first, (bytes, bytearray)):
+            return _decode(_lines(source))
+        return ((doc, None) for doc in source)
+    return iter(())
+
+
+def item_function(validator, name, values=False):
+    '''Raw generated function validating documents (or list items)'''
+    validator[name]  # Compile if lazy
+    if not values:
+        return validator.__dict__[hash_obj(name)]
+
+    schema = validator.flat_rules(name)
+    if (not isinstance(schema, dict) or schema.get('type') != 'list' or
+            not schema.keys() <= _STREAM_RULES):
+        raise ValueError(f'Schema {name} is not a list that can be streamed')
+    rules = schema.get('values')
+    if not rules:
+        return lambda o, args: (o, None)
+    options = validator.schema_options(name).replace(**schema)
+    fname = (hash_obj(rules) if isinstance(rules, str) else
+             hash_obj(rules, options.__dict__))
+    # Values inlined into the list have no function of their own
+    return (validator.__dict__.get(fname) or
+            validator.compile_rules(rules, options))
+
+
+def validate_stream(validator, name, source, args=None, values=False):
+    '''
+    Yields (doc, None) for valid documents and (None, err) for invalid ones.
+    Errors of list items are reported at their index in the stream.
+    '''
+    f = item_function(validator, name, values)
+    structured = validator.schema_options(name).structured_errors
+    for i, (doc, err) in enumerate(documents(source)):
+        if not err:
+            doc, err = f(doc, args)
+        if err:
+            if values:
+                err.at('[{}]', i)
+            yield None, err if structured else err.render('Input')
+        else:
+            yield doc, None
+
+
+def split_stream(validator, name, source, valid, invalid, args=None,
+                 values=False):
+    '''
+    Calls valid(doc) for valid documents and invalid(index, err) for the rest.
+    Returns counts of valid and invalid documents.
+    '''
+    n_valid = n_invalid = 0
+    for i, (doc, err) in enumerate(
+            validate_stream(validator, name, source, args, values)):
+        if err:
+            invalid(i, err)
+            n_invalid += 1
+        else:
+            valid(doc)
+            n_valid += 1
+    return n_valid, n_invalid
+
+
+async def _adocuments(source):
+    if hasattr(source, '__aiter__'):
+        async for doc in source:
+            yield doc, None
+    else:
+        for doc, err in documents(source):
+            yield doc, err
+
+
+async def validate_stream_async(validator, name, source, args=None,
+                                concurrency=16):
+    '''
+    Yields (doc, err) in the input order, with up to `concurrency`
+    documents being validated at once
+    '''
+    structured = validator.schema_options(name).structured_errors
+    pending = deque()
+    try:
+        async for doc, err in _adocuments(source):
+            if err:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result((None, err if structured else
+                                   err.render('Input')))
+            else:
+                future = asyncio.ensure_future(
+                    validator.validate_async(name, doc, args))
+            pending.append(future)
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:  # The consumer may stop early
+        for future in pending:
+            future.cancel()
@@ -5,9 +5,22 @@ Created on Mon Nov 18 11:43:12 2019
 @author: mikhail-matrosov
 """
 
+import asyncio
+import io
+import itertools
+import json
+import pickle
+import subprocess
+import sys
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
 import pytest
 
-from pycoercer import Validator, pycoercer_schema
+from pycoercer import ValidationError, Validator, decoding, pycoercer_schema
+from pycoercer.code_generator import fingerprint, hash_obj
+from pycoercer.shapes import Shapes
 
 
 def test_general():
@@ -138,3 +151,921 @@ def test_general():
     assert v['valuesrules']({'a': 1}) == (None, 'Input.a type must be str')
     assert v['valuesrules2']({'a': 'b'}) == ({'a': 'b'}, None)
     assert v['valuesrules2']({'a': 1}) == (None, 'Input.a type must be str')
+
+
+def test_cache_dir(tmp_path):
+    schemas = {
+        'user': {
+            'type': 'dict',
+            'items': {
+                'id': {'coerce': 'int', 'min': 1},
+                'name': {'type': 'str', 'regex': '[A-Z][a-z]+'},
+                'role': {'enum': ['admin', 'user'], 'default': 'user'},
+                'friends': {'type': 'list', 'values': 'user'}
+            }
+        }
+    }
+
+    v1 = Validator(schemas, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    v2 = Validator(cache_dir=str(tmp_path))
+    v2.generate_function = None  # Must not be called on a cache hit
+    v2.update(schemas)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    doc = {'id': '5', 'name': 'John', 'friends': [{'id': 0, 'name': 'Bob'}]}
+    for v in [v1, v2]:
+        assert v['user'](doc) == (None, 'Input.friends[0].id must be at least 1')
+        assert v['user']({'id': 5.2, 'name': 'John'}) == (
+            {'id': 5, 'name': 'John', 'role': 'user'}, None)
+
+    # Any change of schemas or options must miss the cache
+    Validator(schemas, cache_dir=str(tmp_path), allow_unknown=False)
+    schemas['user']['items']['id']['min'] = 2
+    Validator(schemas, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_export_module(tmp_path):
+    import importlib.util
+
+    schemas = {
+        'user': {
+            'type': 'dict',
+            'items': {
+                'id': {'coerce': 'int', 'min': 1},
+                'name': {'type': 'str', 'regex': '[A-Z][a-z]+'},
+                'role': {'enum': ['admin', 'user'], 'default': 'user'},
+                'gender': {'map': {'m': 'male', 'f': 'female'},
+                           'coerce': 'gender'},
+                'friends': {'type': 'list', 'values': 'user'}
+            }
+        },
+        'recursive_ptr': {'type': 'dict', 'schema': {'v': {}}}
+    }
+    schemas['recursive_ptr']['schema']['v'] = schemas['recursive_ptr']
+    path = tmp_path / 'exported.py'
+    Validator(schemas).export_module(str(path))
+
+    spec = importlib.util.spec_from_file_location('exported', str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    v = module.validator
+    v.coerce_gender = lambda value, args: value.lower()
+
+    assert set(v.registry) == set(schemas)
+    assert v['user']({'id': '5', 'name': 'John', 'gender': 'M'}) == (
+        {'id': 5, 'name': 'John', 'role': 'user', 'gender': 'male'}, None)
+    assert v['user']({'friends': [{'name': 'bob'}]}) == (
+        None, 'Input.friends[0].name must match regex: [A-Z][a-z]+')
+    d = d['v'] = {'v': {}}
+    assert v['recursive_ptr'](d) == (d, None)
+
+    # The exported validator can still be extended
+    v['team'] = {'type': 'list', 'values': 'user'}
+    assert v['team']([{'id': 0}]) == (None, 'Input[0].id must be at least 1')
+
+
+def test_lazy():
+    v = Validator({
+        'id': {'coerce': 'int', 'examples': ['1']},
+        'user': {'type': 'dict', 'items': {'id': 'id', 'friend': 'user'}},
+        'team': {'type': 'list', 'values': 'user'},
+        'bad': {'type': 'int', 'examples': ['1']}
+    }, lazy=True)
+
+    assert v.registry == {}
+    assert v['user']({'id': '1', 'friend': {'id': 2}}) == (
+        {'id': 1, 'friend': {'id': 2}}, None)
+    assert set(v.registry) == {'user', 'id'}
+
+    v.warmup(['team'])
+    assert set(v.registry) == {'user', 'id', 'team'}
+
+    # Redefinition of a compiled schema takes effect immediately
+    v['id'] = {'type': 'int'}
+    assert v['team']([{'id': '1'}]) == (None, 'Input[0].id type must be int')
+
+    # Examples are tested when a schema is compiled
+    with pytest.raises(ValueError):
+        v['bad']
+    with pytest.raises(KeyError):
+        v['unknown']
+
+
+def test_fingerprint():
+    a = {'type': 'dict', 'schema': {'id': {'type': 'int'}}}
+    a['schema']['v'] = a
+    b = {'type': 'dict', 'schema': {'id': {'type': 'int'}}}
+    b['schema']['v'] = b
+    c = {'type': 'dict', 'schema': {'id': {'type': 'int'}}}
+    c['schema']['v'] = c['schema']
+
+    assert fingerprint(a) == fingerprint(b) != fingerprint(c)
+    assert fingerprint({'x', 'y', 1}) == fingerprint({1, 'y', 'x'})
+    assert fingerprint([1]) != fingerprint([True]) != fingerprint([1.0])
+    assert fingerprint({1: 'a'}) != fingerprint({'1': 'a'})
+    shared = [1, 2]
+    assert fingerprint([shared, shared]) == fingerprint([[1, 2], [1, 2]])
+
+    # Shared sub-schemas are digested once, not once per path to them
+    node = {'type': 'int'}
+    for _ in range(40):
+        node = {'type': 'dict', 'items': {'a': node, 'b': node}}
+    memo = {}
+    fingerprint(node, memo)
+    assert len(memo) == 81
+
+    memo = {}
+    assert hash_obj(a, {'x': 1}, memo=memo) == hash_obj(b, {'x': 1})
+    assert hash_obj(a, {'x': 1}, memo=memo) == hash_obj(b, {'x': 1})
+
+    code = ('from pycoercer.code_generator import hash_obj;'
+            'print(hash_obj({"enum": {"a", "b", "c"}}, {"x": [1, 2.5]}))')
+    names = {subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE,
+                            env={'PYTHONHASHSEED': seed,
+                                 'PYTHONPATH': ':'.join(sys.path)}).stdout
+             for seed in ['1', '2', '3']}
+    assert len(names) == 1
+
+
+def test_dependents():
+    v = Validator({
+        'user': {'type': 'dict', 'items': {'uid': 'ident', 'boss': 'user'}},
+        'team': {'type': 'list', 'values': 'user'},
+        'other': {'type': 'int'}
+    })
+    assert v.dependency_graph() == {
+        'user': {'ident', 'user'}, 'team': {'user'}, 'other': set()}
+    assert v.dependents(['ident']) == {'user', 'team'}
+
+    # Forward reference compiled before the referenced schema is defined
+    other = v['other']
+    v['ident'] = {'type': 'int', 'rename': 'id', 'default': 0}
+    assert v['team']([{'uid': '1'}, {}]) == (
+        None, 'Input[0].uid type must be int')
+    assert v['team']([{'uid': 1}, {}]) == ([{'id': 1}, {'id': 0}], None)
+    assert v['other'] is other
+
+    v['ident'] = {'type': 'int', 'rename': 'key'}
+    assert v['user']({'uid': 1, 'boss': {'uid': 2}}) == (
+        {'key': 1, 'boss': {'key': 2}}, None)
+
+
+def test_inline():
+    schema = {
+        'type': 'dict',
+        'items': {
+            'id': {'coerce': 'int', 'min': 1},
+            'name': {'type': 'str', 'rename': 'title', 'default': ''},
+            'tag': {'type': 'str', 'synonyms': ['label']},
+            'scores': {'type': 'list', 'values': {'type': 'int', 'max': 9}},
+            'meta': {'type': 'dict', 'values': {'type': 'str'}},
+            'parent': 'node'
+        }
+    }
+    docs = [
+        {'id': '5', 'name': 'a', 'label': 'x', 'scores': [1, 2]},
+        {'id': 0}, {'id': 'x'}, {'scores': [1, 10]}, {'label': 1},
+        {'meta': {'a': 1}}, {'parent': {'id': '2', 'parent': {'id': -1}}}
+    ]
+    inlined = Validator({'node': schema})
+    called = Validator({'node': schema}, inline_limit=0)
+    for doc in docs:
+        assert inlined['node'](doc) == called['node'](doc)
+
+    src = inlined['node'].__wrapped__.src
+    assert src.count('err = ') == 3  # Containers and refs are still called
+    assert called['node'].__wrapped__.src.count('err = ') == 6
+
+    # Inlined leaves are not compiled on their own, unless needed later
+    for v, compiled in [(inlined, False), (called, True)]:
+        leaf = hash_obj(schema['items']['id'], v.options.__dict__)
+        assert (leaf in v.__dict__) == compiled
+    v = Validator({'rec': {'type': 'dict', 'items': {'a': {'coerce': 'int'}}},
+                   'ints': {'type': 'list', 'values': {'type': 'int'}}})
+    assert v.validate_columns('rec', {'a': ['1', 2]}) == ({'a': [1, 2]}, [])
+    assert list(v.validate_stream('ints', [1, 'x'], values=True)) == [
+        (1, None), (None, 'Input[1] type must be int')]
+
+
+def test_pure():
+    v = Validator({
+        'node': {'type': 'dict', 'items': {
+            'id': {'type': 'int', 'min': 0},
+            'tags': {'type': 'list', 'values': {'type': 'str'}},
+            'children': {'type': 'list', 'values': 'node'}}},
+        'coerced': {'type': 'dict', 'items': {
+            'node': 'node',
+            'deep': {'type': 'list', 'values': {'coerce': 'int'}}}},
+        'purged': {'type': 'dict', 'purge_unknown': True, 'items': {
+            'node': 'node'}}
+    })
+
+    doc = {'id': 1, 'tags': ['a'], 'children': [{'id': 2}], 'x': 0}
+    assert v['node'](doc)[0] is doc
+    assert v['node']({'children': [{'id': -1}]}) == (
+        None, 'Input.children[0].id must be at least 0')
+    assert 'copy' not in v['node'].__wrapped__.src
+
+    out, err = v['coerced']({'node': doc, 'deep': ['1']})
+    assert out == {'node': doc, 'deep': [1]} and out['node'] is doc
+    assert v['purged']({'node': doc, 'x': 1}) == ({'node': doc}, None)
+
+
+def test_inplace():
+    schema = {'type': 'dict', 'allow_unknown': False, 'items': {
+        'id': {'coerce': 'int'},
+        'name': {'rename': 'title', 'default': ''},
+        'tags': {'type': 'list', 'values': {'coerce': 'str'}}}}
+    v = Validator({'doc': schema}, inplace=True)
+
+    tags = [1, 'a']
+    doc = {'id': '1', 'name': 'x', 'tags': tags}
+    out, err = v['doc'](doc)
+    assert out is doc and doc['tags'] is tags
+    assert doc == {'id': 1, 'title': 'x', 'tags': ['1', 'a']}
+    assert v['doc']({'id': 1, 'x': 0}) == (
+        None, "Input must not contain keys {'x'}")
+
+    doc = {'id': '1', 'name': 'x', 'tags': tags}
+    assert Validator({'doc': schema})['doc'](doc)[0] is not doc
+    assert doc == {'id': '1', 'name': 'x', 'tags': tags}
+
+
+def test_is_valid():
+    v = Validator({
+        'id': {'coerce': 'int', 'min': 1},
+        'node': {'type': 'dict', 'allow_unknown': False, 'items': {
+            'id': 'id',
+            'name': {'type': 'str', 'regex': '[a-z]+', 'rename': 'title'},
+            'kind': {'map': {'a': 'A'}, 'enum': ['A', 'B'], 'default': 'A'},
+            'tags': {'type': 'list', 'values': {'type': 'str'}, 'max_len': 2},
+            'meta': {'type': 'dict', 'keys': {'regex': 'm.*'},
+                     'values': {'type': 'int'}},
+            'n': {'nullable': True,
+                  'any_of': [{'type': 'int'}, {'coerce': 'int'}]},
+            'one': {'one_of': [{'type': 'int', 'min': 5},
+                               {'type': 'int', 'max': 7}]},
+            'alias': {'synonyms': ['al'], 'type': 'int', 'required': True},
+            'kids': {'type': 'list', 'values': 'node'},
+            'd': {'type': 'dict', 'min_len': 2, 'items': {'x': {'default': 1}}}
+        }}
+    }, inplace=True)
+    values = {
+        'id': ['1', 0, 'x'], 'name': ['ab', 'A'], 'kind': ['a', 'B', 'C'],
+        'tags': [['a'], ['a', 'b', 'c'], [1]], 'meta': [{'m1': 1}, {'z': 1}],
+        'n': [None, '2', 'x'], 'one': [1, 6, 9], 'alias': [1, 'x'],
+        'al': [2, 'y'], 'kids': [[{'alias': 1}], [{}]], 'd': [{}, {'y': 1}],
+        'zz': [1]}
+
+    for keys in itertools.combinations(values, 2):
+        for fields in itertools.product(*(values[k] for k in keys)):
+            doc = {'alias': 1, **dict(zip(keys, fields))}
+            copy = deepcopy(doc)
+            assert v.is_valid('node', doc) == (not v['node'](copy)[1]), doc
+            assert v.checker['node'](doc, None) == v.is_valid('node', doc)
+
+    assert not v.is_valid('node', {'alias': 1, 'id': 'x'})
+    v['id'] = {'type': 'str'}
+    assert v.is_valid('node', {'alias': 1, 'id': 'x'})
+    with pytest.raises(KeyError):
+        v.is_valid('unknown', {})
+
+
+def test_structured_errors():
+    schema = {'type': 'dict', 'items': {
+        'id': {'coerce': 'int', 'min': 1},
+        'tags': {'type': 'list', 'values': {'type': 'dict', 'items': {
+            'key': {'type': 'str', 'required': True},
+            'value': {'any_of': [{'type': 'int'}, {'type': 'str'}]}}}}}}
+    v = Validator({'doc': schema}, structured_errors=True)
+    strings = Validator({'doc': schema})
+
+    for doc in [{'id': 'x'}, {'id': 0}, {'tags': [{'key': 'a'}, {}]},
+                {'tags': [{'key': 'a', 'value': None}]}]:
+        assert str(v['doc'](doc)[1]) == strings['doc'](doc)[1]
+
+    err = v['doc']({'tags': [{'key': 'a'}, {'key': 1}]})[1]
+    assert isinstance(err, ValidationError)
+    assert err.path == ('tags', 1, 'key')
+    assert (err.code, err.param) == ('type', 'str')
+    assert err.message == ' type must be str'
+
+    err = v['doc']({'tags': [{'key': 'a', 'value': None}]})[1]
+    assert err.code == 'any_of' and err.path == ('tags', 0, 'value')
+    assert [e.code for e in err.param] == ['type', 'type']
+
+
+def test_validate_many():
+    v = Validator({
+        'flat': {'type': 'dict', 'items': {
+            'id': {'coerce': 'int', 'min': 1},
+            'name': {'nullable': True, 'if_null': '', 'type': 'str'}}},
+        'nested': {'type': 'list', 'values': 'flat'},
+        'ints': {'type': 'list', 'values': {'type': 'int', 'min': 0}},
+        'map': {'type': 'dict', 'keys': {'type': 'str'},
+                'values': {'coerce': 'int'}}
+    })
+    docs = [{'id': '1'}, {'id': 0}, None, {'id': 2, 'name': None}, {'id': 'x'}]
+    for name, items in [('flat', docs), ('nested', [[d] for d in docs]),
+                        ('ints', [[1, 2], [], [1, -1], [0, 'a'], 3]),
+                        ('map', [{'a': '1'}, {'a': 'x'}, {1: 2}, {}, 'a'])]:
+        out, errors = v.validate_many(name, iter(items))
+        results = [v[name](doc) for doc in items]
+        assert out == [doc for doc, err in results]
+        assert errors == [(i, err) for i, (doc, err) in enumerate(results)
+                          if err]
+
+    v['flat'] = {'type': 'dict', 'items': {'id': {'type': 'str'}}}
+    assert v.validate_many('nested', [[{'id': 'a'}], [{'id': 1}]]) == (
+        [[{'id': 'a'}], None], [(1, 'Input[0].id type must be str')])
+
+
+def test_validate_columns():
+    v = Validator({'rec': {'type': 'dict', 'items': {
+        'id': {'coerce': 'int', 'min': 1},
+        'score': {'type': 'float', 'max': 10},
+        'kind': {'type': 'str', 'enum': ['a', 'b'], 'max_len': 1},
+        'n': {'type': 'number', 'synonyms': ['num']},
+        'name': {'type': 'str', 'rename': 'title', 'regex': '[a-z]+'},
+        'd': {'default': 5}}}})
+
+    def check(columns):
+        out, errors = v.validate_columns('rec', columns)
+        lists = {k: c if isinstance(c, list) else c.tolist()
+                 for k, c in columns.items()}
+        rows = [v['rec']({k: c[i] for k, c in lists.items()})
+                for i in range(len(lists['id']))]
+        assert errors == [(i, err) for i, (doc, err) in enumerate(rows) if err]
+        for i, (doc, err) in enumerate(rows):
+            if doc:
+                assert doc == {k: c[i] for k, c in out.items()}
+        return errors
+
+    columns = {'id': [1.5, 0, 'x', 3], 'score': [1.0, 11.0, 2.0, 3.0],
+               'kind': ['a', 'c', 'b', 'bb'], 'num': [1, 2, 3.5, 4],
+               'name': ['ab', 'x', 'Q', 'z']}
+    assert [i for i, err in check(columns)] == [1, 2, 3]
+    check({**columns, 'extra': [0] * 4})
+    strict = Validator({'rec': {'type': 'dict', 'items': {'id': {}}}},
+                       allow_unknown=False)
+    assert strict.validate_columns('rec', {'id': [1], 'extra': [0]}) == (
+        {'id': [1], 'extra': [0]}, [(0, "Input must not contain keys {'extra'}")])
+
+    np = pytest.importorskip('numpy')
+    columns = {'id': np.array([1.5, 0, 2, 3]),
+               'score': np.array([1.0, 11.0, 2.0, 3.0]),
+               'kind': np.array(['a', 'c', 'b', 'bb']),
+               'num': np.array([1, 2, 3, 4]),
+               'name': np.array(['ab', 'x', 'Q', 'z'])}
+    assert [i for i, err in check(columns)] == [1, 2, 3]
+    assert check({**columns, 'score': np.array([1, 2, 3, 4])})
+
+
+def test_validate_columns_like_rows():
+    schemas = {
+        'strict': {'type': 'dict', 'allow_unknown': False, 'items': {
+            'a': {'type': 'int'}}},
+        'purged': {'type': 'dict', 'purge_unknown': True, 'require_all': True,
+                   'items': {'a': {'type': 'int', 'synonyms': ['b']}}},
+        'renamed': {'type': 'dict', 'items': {
+            'a': {'type': 'int', 'synonyms': ['b'], 'rename': 'c'},
+            'd': {'rename': 'a'}}},
+        'coerced': {'type': 'dict', 'items': {
+            'i': {'coerce': 'int'}, 'b': {'coerce': 'bool'},
+            'e': {'enum': [1, 'a']}, 'f': {'coerce': 'bool', 'enum': [True]}}}}
+    v = Validator(schemas)
+
+    def check(name, columns):
+        out, errors = v.validate_columns(name, columns)
+        lists = {k: c if isinstance(c, list) else c.tolist()
+                 for k, c in columns.items()}
+        rows = [v[name]({k: c[i] for k, c in lists.items()})
+                for i in range(len(next(iter(lists.values()))))]
+        assert errors == [(i, err) for i, (doc, err) in enumerate(rows) if err]
+        for i, (doc, err) in enumerate(rows):
+            if doc:
+                assert doc == {k: c[i] for k, c in out.items()}
+
+    check('strict', {'a': [1, 2]})
+    check('strict', {'a': [1, 2], 'x': [3, 4]})
+    check('purged', {'b': [1, 2], 'x': [3, 4]})
+    check('purged', {'x': [3, 4]})
+    check('renamed', {'a': [1], 'b': [2], 'c': [3], 'd': [4], 'x': [5]})
+    check('renamed', {'b': [2], 'c': [3], 'x': [5]})
+
+    np = pytest.importorskip('numpy')
+    check('strict', {'a': np.array([1, 2]), 'x': np.array([3, 4])})
+    check('renamed', {k: np.array([i]) for i, k in enumerate('abcdx')})
+    check('coerced', {
+        'i': np.array([1e20, -1.5, 3.0, 2.0, 0.0, 1.0]),
+        'b': np.array(['Yes', 'n', '1.0', 'x', '0', 'TRUE']),
+        'e': np.array(['1', 'a', 'a', 'a', 'a', 'a']),
+        'f': np.array([1.0, 0.0, -0.0, 2.0, 1.0, 1.0])})
+    check('coerced', {
+        'i': np.array([2 ** 64 - 1, 1], np.uint64),
+        'b': np.array([1, 0]), 'e': np.array([1, 2]),
+        'f': np.array([True, False])})
+
+
+def test_validate_stream():
+    v = Validator({
+        'rec': {'type': 'dict', 'items': {'id': {'coerce': 'int', 'min': 1}}},
+        'recs': {'type': 'list', 'values': 'rec'}})
+    docs = [{'id': '1'}, {'id': 0}, {'id': 2}]
+    expected = [({'id': 1}, None), (None, 'Input.id must be at least 1'),
+                ({'id': 2}, None)]
+    ndjson = ''.join(json.dumps(d) + '\n' for d in docs) + '\n{oops\n'
+    data = ndjson.encode()
+    for source in [docs, io.StringIO(ndjson), io.BytesIO(data),
+                   (data[i:i + 5] for i in range(0, len(data), 5))]:
+        out = list(v.validate_stream('rec', source))
+        assert out[:3] == expected
+        if len(out) > 3:
+            assert out[3][1].startswith('Input is not valid JSON: ')
+
+    assert list(v.validate_stream('recs', docs, values=True)) == [
+        ({'id': 1}, None), (None, 'Input[1].id must be at least 1'),
+        ({'id': 2}, None)]
+    with pytest.raises(ValueError):
+        list(v.validate_stream('rec', docs, values=True))
+
+    valid, invalid = [], []
+    assert v.split_stream('rec', iter(docs), valid.append,
+                          lambda i, err: invalid.append(i)) == (2, 1)
+    assert valid == [{'id': 1}, {'id': 2}] and invalid == [1]
+
+
+def coerce_upper(value, args=None):
+    return value.upper()
+
+
+def test_pickle():
+    v = Validator({
+        'code': {'type': 'str', 'coerce': 'upper', 'enum': ['A', 'B']},
+        'rec': {'type': 'dict', 'items': {'code': 'code',
+                                          'id': {'coerce': 'int'}}},
+        'recs': {'type': 'list', 'values': 'rec'}},
+        lazy=True, allow_unknown=False)
+    v.coerce_upper = coerce_upper
+    v['rec']
+    docs = [{'code': 'a', 'id': '1'}, {'code': 'c'}, {'x': 1}, None]
+
+    w = pickle.loads(pickle.dumps(v))
+    assert set(w.registry) == {'rec', 'code'} and w.lazy
+    for doc in docs:
+        assert w['rec'](doc) == v['rec'](doc)
+        assert w['recs']([doc]) == v['recs']([doc])
+
+    assert v.validate_parallel('rec', docs * 3, workers=2, chunksize=2) == (
+        v.validate_many('rec', docs * 3))
+
+
+def test_threads():
+    v = Validator({'tree': {'type': 'dict', 'items': {
+        'value': {'type': 'int'},
+        'children': {'type': 'list', 'values': 'tree'}}}})
+    bad = {'value': 0, 'children': [{'value': i, 'children': []}
+                                    for i in range(200)] + [{'value': 'x'}]}
+    good = deepcopy(bad)
+    good['children'][-1]['value'] = 1
+    loop = {'value': 0, 'children': []}
+    loop['children'].append(loop)
+
+    def work(i):
+        return [(v['tree'](bad)[1], v['tree'](good)[1], v.is_valid('tree', bad),
+                 v['tree'](loop)[1]) for _ in range(50)]
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(8) as pool:
+            results = [r for rs in pool.map(work, range(16)) for r in rs]
+    finally:
+        sys.setswitchinterval(interval)
+    assert set(results) == {('Input.children[200].value type must be int',
+                             None, False, None)}
+
+
+def test_validate_async():
+    class AsyncValidator(Validator):
+        active = peak = 0
+
+        async def coerce_lookup(self, value, args):
+            AsyncValidator.active += 1
+            AsyncValidator.peak = max(self.peak, self.active)
+            await asyncio.sleep(0.01)
+            AsyncValidator.active -= 1
+            if value == 'bad':
+                raise KeyError(value)
+            return value.upper()
+
+    schemas = {
+        'code': {'type': 'str', 'coerce': 'lookup'},
+        'rec': {'type': 'dict', 'items': {
+            'a': 'code', 'b': {'coerce': 'lookup', 'rename': 'B'},
+            'c': {'type': 'int'},
+            'tags': {'type': 'list', 'values': 'code'},
+            'kids': {'type': 'list', 'values': 'rec'},
+            'either': {'any_of': [{'type': 'int'}, 'code']}}},
+        'plain': {'type': 'dict', 'items': {'x': {'type': 'int'}}}}
+    v = AsyncValidator(schemas)
+    doc = {'a': 'x', 'b': 'y', 'c': 1, 'tags': ['p', 'q'],
+           'kids': [{'a': 'k', 'either': 2}], 'either': 's'}
+    assert asyncio.run(v.validate_async('rec', doc)) == ({
+        'a': 'X', 'B': 'Y', 'c': 1, 'tags': ['P', 'Q'],
+        'kids': [{'a': 'K', 'either': 2}], 'either': 'S'}, None)
+    assert AsyncValidator.peak == 6  # All coercions at once
+    assert asyncio.run(v.validate_async('rec', {'kids': [{'tags': ['bad']}]})
+                       ) == (None, 'Input.kids[0].tags[0] is not coercible '
+                                   'to lookup')
+
+    # No coroutine coercers - no async code
+    assert asyncio.run(v.validate_async('plain', {'x': 1})) == ({'x': 1}, None)
+    assert v.coroutine['plain'] is None
+
+    async def stream():
+        AsyncValidator.peak = 0
+        docs = [{'a': str(i)} for i in range(10)] + [{'a': 'bad'}]
+        return [r async for r in v.validate_stream_async('rec', docs,
+                                                         concurrency=4)]
+
+    results = asyncio.run(stream())
+    assert results[:10] == [({'a': str(i)}, None) for i in range(10)]
+    assert results[10] == (None, 'Input.a is not coercible to lookup')
+    assert AsyncValidator.peak == 4
+
+
+def test_break_loops():
+    nested = {'type': 'dict', 'items': {'id': {'type': 'int'}}}
+    nested['items']['next'] = nested
+    schemas = {
+        'flat': {'type': 'dict', 'items': {'id': {'type': 'int'}}},
+        'tree': {'type': 'dict', 'items': {
+            'kids': {'type': 'list', 'values': 'tree'}}},
+        'a': {'type': 'dict', 'items': {'b': 'b'}},
+        'b': {'type': 'dict', 'items': {'a': 'a', 'flat': 'flat'}},
+        'nested': {'type': 'dict', 'items': {'head': nested}}}
+
+    def guarded(v):
+        return {name for name in schemas
+                if hasattr(v.__dict__[hash_obj(name)], 'locks')}
+
+    v = Validator(schemas)
+    assert guarded(v) == {'tree', 'a', 'b'}
+    assert hasattr(v.__dict__[hash_obj(nested, v.options.__dict__)], 'locks')
+
+    d = {'id': 1}
+    d['next'] = d
+    assert v['nested']({'head': d}) == ({'head': {'id': 1, 'next': d}}, None)
+    d = {'a': {}}
+    d['a']['b'] = d
+    assert v['b'](d)[1] is None
+    assert v.is_valid('b', d)
+
+    # The registry shares the guard: the loop is cut at its first revisit
+    v = Validator({'n': {'type': 'dict', 'items': {
+        'id': {'coerce': 'int'}, 'child': 'n'}}})
+    d = {'id': '1'}
+    d['child'] = d
+    out, err = v['n'](d)
+    assert out == {'id': 1, 'child': d} and out['child'] is d
+
+    assert guarded(Validator(schemas, break_loops=False)) == set()
+
+
+def test_memo(tmp_path):
+    calls = []
+
+    def coerce_addr(value, args=None):
+        calls.append(value)
+        return str(value).strip().title()
+
+    schemas = {
+        'addr': {'coerce': 'addr'},
+        'rec': {'type': 'dict', 'items': {'home': 'addr', 'work': 'addr',
+                                          'zip': {'coerce': 'zip',
+                                                  'memo': 2}}}}
+    v = Validator(schemas)
+    v.coerce_zip = coerce_upper
+    v.register_coercer('addr', coerce_addr, memo=2)
+    for doc in [{'home': ' main st', 'work': ' main st'},
+                {'home': 1, 'work': True}, {'home': ['x']}]:
+        v['rec'](doc)
+    assert calls == [' main st', 1, True, ['x']]
+    assert v.memo_stats()['addr'] == {'hits': 1, 'misses': 3, 'size': 2,
+                                      'maxsize': 2}
+    assert v['rec']({'home': 1})[0] == {'home': '1'}
+    assert len(calls) == 4
+
+    v['rec']({'zip': 'a'})
+    v['rec']({'zip': 'a'})
+    assert v.memo_stats()['zip']['hits'] == 1
+    v.clear_memos()
+    assert v.memo_stats()['zip'] == {'hits': 0, 'misses': 0, 'size': 0,
+                                     'maxsize': 2}
+
+    # Declarations apply to every rule set calling the coercer, whatever
+    # the order of compilation
+    for items, lazy in itertools.product(
+            [{'a': {'coerce': 'zip'}, 'b': {'coerce': 'zip', 'memo': 4}},
+             {'b': {'coerce': 'zip', 'memo': 4}, 'a': {'coerce': 'zip'}}],
+            [False, True]):
+        w = Validator(lazy=lazy)
+        w.coerce_zip = coerce_upper
+        w.update({'rec': {'type': 'dict', 'items': items}, 'a': items['a']})
+        w.warmup()
+        w['a']('x')
+        w['rec']({'a': 'x'})
+        assert w.memo_stats()['zip']['hits'] == 1
+    w = Validator()
+    with pytest.raises(ValueError, match='builtin coercer int'):
+        w.update({'n': {'coerce': 'int', 'memo': 4}})
+    assert 'int' not in w.memo_stats()
+
+    # Declared memos survive pickling and the on-disk cache
+    v.register_coercer('addr', coerce_upper)  # Picklable
+    v2 = pickle.loads(pickle.dumps(v))
+    assert set(v2.memo_stats()) == {'addr', 'zip'}
+    for _ in range(2):
+        v3 = Validator(cache_dir=str(tmp_path))
+        v3.register_coercer('addr', coerce_addr, memo=2)
+        v3.coerce_zip = coerce_upper
+        v3.update(schemas)
+        v3['rec']({'zip': 'a'})
+        v3['rec']({'zip': 'a'})
+        assert v3.memo_stats()['zip']['hits'] == 1
+
+
+def test_profile():
+    schemas = {'rec': {'type': 'dict', 'items': {
+        'x': {'coerce': 'int', 'min': 0},
+        'tags': {'type': 'list', 'values': {'type': 'str',
+                                            'regex': '[a-z]+'}}}}}
+    plain = Validator(schemas)
+    v = Validator(schemas, profile=True)
+    assert '_ns()' not in plain.__dict__[hash_obj('rec')].src
+    assert '_ns()' in v.__dict__[hash_obj('rec')].src
+    assert plain.stats() == {}
+
+    docs = [{'x': '1', 'tags': ['a']}, {'x': '-1'}, {'x': 'q'},
+            {'tags': ['a', 'B']}, []]
+    for doc in docs:
+        assert v['rec'](doc) == plain['rec'](doc)
+    assert v.validate_many('rec', docs) == plain.validate_many('rec', docs)
+    assert v.is_valid('rec', docs[0])  # Not instrumented
+
+    rec = v.stats()['rec']
+    assert (rec['calls'], rec['failures']) == (10, 8)
+    assert rec['ns'] > 0
+    assert rec['errors'] == {('min', ('x',)): 2, ('coerce', ('x',)): 2,
+                             ('regex', ('tags', 1)): 2, ('type', ()): 2}
+    assert rec['rules']['type']['failures'] == 2
+    assert rec['rules']['items']['calls'] == 8
+    x = v.stats()[repr(schemas['rec']['items']['x'])]['rules']
+    assert x['coerce']['calls'] == 6 and x['coerce']['failures'] == 2
+    assert x['min']['errors'] == {('min', ()): 2}
+
+    v.reset_stats()
+    assert v.stats() == {}
+    v['rec']({'x': 1})
+    assert v.stats()['rec']['calls'] == 1
+
+
+def test_union_dispatch():
+    def event(kind, **items):
+        return {'type': 'dict', 'items': {
+            'kind': {'type': 'str', 'enum': kind, 'required': True}, **items}}
+
+    def schemas(tag_rules):
+        click, view = event(['click'], x={'coerce': 'int'}), event(['view'])
+        for branch in (click, view):
+            branch['items']['kind'].update(tag_rules)
+        return {
+            'click': click,
+            'any': {'any_of': ['click', view,
+                               event(['a', 'b'], n={'type': 'int'})]},
+            'one': {'one_of': ['click', view,
+                               event(['a', 'b'], n={'type': 'int'})]},
+            'dis': {'one_of': [click, view],
+                    **({} if tag_rules else {'discriminator': 'kind'})}}
+
+    v = Validator(schemas({}))
+    plain = Validator(schemas({'map': {}}))  # Can't dispatch on 'kind'
+    for name in ['any', 'one']:
+        assert 'branch = ' in v.__dict__[hash_obj(name)].src
+        assert 'branch = ' not in plain.__dict__[hash_obj(name)].src
+    docs = [{'kind': 'click', 'x': '1'}, {'kind': 'click', 'x': 'q'},
+            {'kind': 'view'}, {'kind': 'b', 'n': 1}, {'kind': 'b', 'n': 'q'},
+            {'kind': 'z'}, {'kind': []}, {}, [], None]
+    for name in ['any', 'one', 'dis']:
+        for doc in docs:
+            assert v[name](doc) == plain[name](doc)
+            assert v.is_valid(name, doc) == plain.is_valid(name, doc)
+
+    with pytest.raises(ValueError):
+        Validator({'x': {'discriminator': 'kind', 'one_of': [
+            {'type': 'dict', 'items': {'kind': {'enum': ['a', 'b']}}},
+            {'type': 'dict', 'items': {'kind': {'enum': ['b']}}}]}})
+
+    # Type-only unions are a single isinstance, one_of stops early
+    v = Validator({
+        'any': {'any_of': [{'type': 'int'}, {'type': 'str'}, {'type': None}]},
+        'one': {'one_of': [{'type': 'int'}, {'type': 'number'},
+                           {'type': 'bool'}]},
+        'ones': {'one_of': [{'min': 1}, {'min': 2}, {'min': 3}]}})
+    assert v['any'](None) == (None, None)
+    assert v['any'](1.5) == (None, 'Input must satisfy any of 3 rules:\n'
+                                   '1: ^ type must be int\n'
+                                   '2: ^ type must be str\n'
+                                   '3: ^ type must be NoneType')
+    assert v['one'](1.5) == (1.5, None)
+    assert not v.is_valid('one', True)
+    assert v['ones'](5) == (None, 'Input must satisfy exactly one of 3 rules:'
+                                  '\n1: ok\n2: ok\n3: not checked')
+    assert v['ones'](2)[1] and v['ones'](1) == (1, None)
+
+    v = Validator({'one': {'one_of': [{'type': 'int'}, {'type': None}]}})
+    for doc in [None, 1]:
+        assert v['one'](doc) == (doc, None) and v.is_valid('one', doc)
+    for doc in ['x', {}]:
+        assert v['one'](doc)[1] and not v.is_valid('one', doc)
+
+    # Unless a branch normalizes
+    v = Validator({'u': {'any_of': [{'type': 'dict'}, {'type': 'int'}]},
+                   'o': {'one_of': [{'type': 'dict'}, {'type': 'int'}]}},
+                  purge_unknown=True)
+    for name in ['u', 'o']:
+        assert v[name]({'a': 1}) == ({}, None) and v[name](1) == (1, None)
+        assert v.is_valid(name, {'a': 1})
+
+
+def test_allocations():
+    v = Validator({
+        'rec': {'type': 'dict', 'items': {
+            'id': {'type': 'int', 'min': 0},
+            'name': {'type': 'str', 'synonyms': ['title']},
+            'tags': {'type': 'list', 'values': {'type': 'str'}},
+            'meta': {'type': 'dict', 'items': {'v': {'type': 'int'}},
+                     'values': {'type': 'int'}}}},
+        'strict': {'type': 'dict', 'allow_unknown': False, 'items': {
+            str(i): {'type': 'int'} for i in range(1000)}}})
+
+    def transient(f, *args):
+        '''Peak memory of a call on top of what it returns'''
+        f(*args)
+        tracemalloc.start()
+        try:
+            out = f(*args)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        assert out
+        return peak - current
+
+    # Only iterators and small ints, no copies of keys or items
+    n = 1000
+    doc = {'id': 1, 'title': 'x', 'tags': ['a'] * n,
+           'meta': {str(i): i for i in range(n)}}
+    strict = {str(i): i for i in range(n)}
+    assert transient(v['rec'], doc) < 1000
+    assert transient(v['strict'], strict) < 1000
+    assert transient(v.is_valid, 'rec', doc) < 1000
+    assert transient(v.is_valid, 'strict', strict) < 1000
+    assert v['strict']({'x': 1}) == (None,
+                                     "Input must not contain keys {'x'}")
+
+
+def test_specialize():
+    schemas = {
+        'rec': {'type': 'dict', 'items': {
+            'id': {'coerce': 'int', 'synonyms': ['key']},
+            'name': {'type': 'str', 'required': True},
+            'kind': {'default': 'a', 'enum': ['a', 'b']},
+            'any': {},
+            'child': 'rec'}},
+        'strict': {'type': 'dict', 'rules': 'rec', 'allow_unknown': False},
+        'purged': {'type': 'dict', 'rules': 'rec', 'purge_unknown': True},
+        'ints': {'type': 'dict', 'rules': 'rec', 'values': {'type': 'int'}},
+        'pure': {'type': 'dict', 'require_all': True, 'items': {
+            'a': {}, 'b': {'type': 'int'}}}}
+    names = list(schemas)
+    docs = [{'id': '1', 'name': 'x'}, {'key': 2, 'name': 'y', 'kind': 'b'},
+            {'name': 'z', 'extra': 1}, {'name': 'z', 'extra': 'q'},
+            {'id': 'q', 'name': 'x'}, {'id': 1}, {'name': 1},
+            {'name': 'x', 'child': {'name': 'y', 'kind': 'c'}},
+            {'a': 1, 'b': 2}, {'a': 1}, {'b': 'x'}, {}, []]
+    plain = Validator(schemas)
+    v = Validator(schemas, specialize=2, max_shapes=3)
+    for _ in range(3):
+        for name in names:
+            for doc in docs:
+                assert v[name](deepcopy(doc)) == plain[name](deepcopy(doc))
+            assert (v.validate_many(name, docs) ==
+                    plain.validate_many(name, docs))
+
+    shapes = [s for s in v.__dict__.values() if isinstance(s, Shapes)]
+    assert shapes and all(len(s.funcs) == 3 for s in shapes)
+    rec = next(s for s in shapes if s.rules == schemas['rec'])
+    for keys, f in rec.funcs:
+        assert ' in orig' not in f.src
+
+    # Cyclic documents are still caught by the generic function
+    doc = {'name': 'x'}
+    doc['child'] = doc
+    assert v['rec'](doc)[1] is None
+    assert plain.is_valid('rec', doc) == v.is_valid('rec', doc)
+
+
+def test_loads(monkeypatch):
+    schemas = {
+        'node': {'type': 'dict', 'items': {
+            'name': {'type': 'str', 'rename': 'title'},
+            'kids': {'type': 'list', 'values': 'node', 'max_len': 2}}},
+        'order': {'type': 'dict', 'purge_unknown': True, 'items': {
+            'id': {'coerce': 'int', 'required': True},
+            'nick': {'type': 'str', 'synonyms': ['alias']},
+            'lines': {'type': 'list', 'min_len': 1, 'values': {
+                'type': 'dict', 'items': {
+                    'qty': {'type': 'int', 'min': 1},
+                    'sku': {'type': 'str', 'default': '?'}}}},
+            'tree': 'node'}}}
+    v = Validator(schemas)
+    docs = [
+        {'id': '1', 'lines': [{'qty': 1}], 'extra': [1, {}]},
+        {'id': 1, 'alias': 'x', 'nick': 'y', 'lines': [{'qty': 2}]},
+        {'id': 1, 'lines': [{'qty': 1, 'sku': 'a'}, {'qty': 0}]},
+        {'id': 1, 'lines': []}, {'lines': [{'qty': 1}]}, {'id': 'x'},
+        {'id': 1, 'tree': {'name': 'a', 'kids': [{'name': 'b'}]}},
+        {'id': 1, 'tree': {'kids': [{}, {}, {}]}}, {'id': 1, 'tree': None},
+        [], None, 1]
+    for small in [decoding.SMALL, 0]:  # Decoded at once or item by item
+        monkeypatch.setattr(decoding, 'SMALL', small)
+        for doc in docs:
+            for name in schemas:
+                data = json.dumps(doc)
+                expected = v[name](json.loads(data))
+                assert v.loads(name, data) == expected
+                assert v.loads(name, data.encode('utf-16')) == expected
+
+    # Decoding stops at the first error, even before a syntax error
+    assert v.loads('order', '{"id": 1, "lines": [{"qty": 0}, {') == (
+        None, 'Input.lines[0].qty must be at least 1')
+    assert v.loads('order', '{"id": 1} []')[1].startswith(
+        'Input is not valid JSON: Extra data')
+
+    # Only the last value of a repeated key is validated, as by json.loads
+    for data in ['{"id": 1, "lines": [{"qty": 0}], "lines": [{"qty": 1}]}',
+                 '{"id": 1, "lines": [{"qty": 0}], "\\u006cines": []}',
+                 '{"id": 1, "lines": [], "lines": [{"qty": 0}]}',
+                 '{"id": 1, "lines": [{"qty": 0}], "x": "lines"}']:
+        assert v.loads('order', data) == v['order'](json.loads(data))
+    assert v.loads('order', '{"id": 1, "lines": [{"qty": 0}], "lines": {')[
+        1].startswith('Input is not valid JSON')
+
+    v.update({'node': {'type': 'dict', 'items': {'name': {'type': 'int'}}}})
+    assert v.loads('order', '{"id": 1, "tree": {"name": "a"}}') == (
+        None, 'Input.tree.name type must be int')
+
+
+def test_share_code(tmp_path):
+    schemas = {
+        'user': {'type': 'dict', 'allow_unknown': False, 'items': {
+            'name': {'type': 'str', 'regex': '[A-Z][a-z]+'},
+            'role': {'enum': ['admin', 'user'], 'default': 'user'},
+            'friends': {'type': 'list', 'values': 'user'}}}}
+    v1, v2 = (Validator(schemas, share_code=True) for _ in range(2))
+    v3 = Validator(schemas, cache_dir=str(tmp_path))
+    v4 = Validator(cache_dir=str(tmp_path), share_code=True)
+    v4.update(schemas)
+    plain = Validator(schemas)
+
+    docs = [{'name': 'Ann', 'friends': [{'name': 'Bob', 'role': 'admin'}]},
+            {'name': 'ann'}, {'name': 'Ann', 'role': 'x'}, {'x': 1}]
+    for doc in docs:
+        for v in [v1, v2, v3, v4]:
+            assert v['user'](doc) == plain['user'](doc)
+
+    def raw(v):  # 'user' is guarded by a loopbreaker
+        return v.__dict__[hash_obj('user')].__wrapped__
+
+    for v in [v2, v4]:
+        assert raw(v).__code__ is raw(v1).__code__
+        assert raw(v).__globals__ is v.__dict__
+    assert raw(v3).__code__ is not raw(v1).__code__
+    helpers = {k for k, o in v1.__dict__.items()
+               if isinstance(o, frozenset) or
+               getattr(o, '__name__', None) == 'fullmatch'}
+    assert len(helpers) >= 3  # Enum, known keys and regex
+    for k in helpers:
+        assert v2.__dict__[k] is v1.__dict__[k] is v4.__dict__[k]
+
+    report, plain_report = v2.memory_report(), plain.memory_report()
+    assert report['functions'] == plain_report['functions'] > 0
+    assert report['helpers'] == plain_report['helpers'] > 0
+    assert report['bytes'] < plain_report['bytes'] / 2
+    assert report['shared_bytes'] and not plain_report['shared_bytes']
+    assert pickle.loads(pickle.dumps(v2)).memory_report() == report